@@ -0,0 +1,101 @@
+from datetime import datetime
+import threading
+
+
+def error_bits(error_code):
+    """錯誤碼中已設定的 bit，由低到高"""
+    bits = []
+    code = int(error_code or 0)
+    while code:
+        bit = code & -code
+        code ^= bit
+        bits.append(bit)
+    return bits
+
+def duration_hours(alert_time, recovery_time):
+    """告警時長 (小時，字串)，時間格式無法解析時回傳 None"""
+    try:
+        seconds = (datetime.fromisoformat(recovery_time) - datetime.fromisoformat(alert_time)).total_seconds()
+    except ValueError:
+        return None
+    return f"{seconds / 3600:.2f}"
+
+
+class AlarmTracker:
+    """記憶體內的未解除告警索引，以 (schema, serialnumber) 的每個錯誤 bit 為單位
+
+    bit 由 0 變 1 時開啟一筆告警 (同一則訊息新出現的 bit 合併為一筆，以 collecttime 識別)，
+    由 1 變 0 時解除該 bit；一筆告警的 bit 全部解除後才算恢復。告警持續期間不再產生新的告警資料列，
+    判斷時不必查詢 alarm 表。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}  # (schema, serialnumber) -> {bit: 開啟該 bit 的告警 collecttime}
+        self.open_alarms = {}  # (schema, serialnumber, 告警 collecttime) -> 尚未解除的 bit set
+        self.last_seen = {}  # (schema, serialnumber) -> 最後處理的 collecttime
+
+    def open_alarm(self, schema_name, serial_number, alert_time, bits):
+        device = self.active.setdefault((schema_name, serial_number), {})
+        for bit in bits:
+            previous_time = device.get(bit)
+            if previous_time is not None:
+                self.release_bit(schema_name, serial_number, previous_time, bit)
+            device[bit] = alert_time
+        self.open_alarms.setdefault((schema_name, serial_number, alert_time), set()).update(bits)
+
+    def release_bit(self, schema_name, serial_number, alert_time, bit):
+        """解除告警中的一個 bit，整筆告警都已解除時回傳 True"""
+        alarm_key = (schema_name, serial_number, alert_time)
+        remaining = self.open_alarms.get(alarm_key)
+        if remaining is None:
+            return False
+
+        remaining.discard(bit)
+        if remaining:
+            return False
+        del self.open_alarms[alarm_key]
+        return True
+
+    def restore(self, schema_name, serial_number, alert_time, error_code):
+        """由資料庫中未解除的告警重建狀態，需依 collecttime 由舊到新呼叫"""
+        alert_time = str(alert_time)
+        with self.lock:
+            self.open_alarm(schema_name, serial_number, alert_time, error_bits(error_code))
+            device_key = (schema_name, serial_number)
+            if alert_time > self.last_seen.get(device_key, ""):
+                self.last_seen[device_key] = alert_time
+
+    def observe(self, schema_name, serial_number, error_code, collect_time):
+        """處理一筆設備狀態
+
+        回傳 (新出現的 bit 組成的錯誤碼，0 表示沒有新告警, [(告警時間, 恢復時間, 時長)])。
+        """
+        device_key = (schema_name, serial_number)
+        collect_time = str(collect_time)
+
+        with self.lock:
+            if collect_time < self.last_seen.get(device_key, ""):
+                return 0, []  # 重播或亂序的舊資料不改變告警狀態
+            self.last_seen[device_key] = collect_time
+
+            bits = set(error_bits(error_code))
+            device = self.active.get(device_key, {})
+            raised = bits - device.keys()
+
+            resolved = []
+            for bit in device.keys() - bits:
+                alert_time = device.pop(bit)
+                if self.release_bit(schema_name, serial_number, alert_time, bit):
+                    resolved.append((alert_time, collect_time, duration_hours(alert_time, collect_time)))
+
+            if raised:
+                self.open_alarm(schema_name, serial_number, collect_time, raised)
+            elif not device:
+                self.active.pop(device_key, None)
+
+            return sum(raised), resolved
+
+    def active_count(self):
+        with self.lock:
+            return len(self.open_alarms)
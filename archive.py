@@ -0,0 +1,280 @@
+from datetime import datetime
+from functools import reduce
+from pathlib import Path
+import operator
+import threading
+import time
+import metrics
+from sinks import Sink
+from modbus_mapping import column_type_for
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # 只有 SINKS 包含 parquet 或讀取封存時才需要
+    pa = None
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+STATISTICS_COLUMNS = ("serialnumber", "collecttime")  # 寫入 row group 統計值、供讀取時略過 row group 的欄位
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("Parquet archive requires pyarrow (pip install pyarrow)")
+
+def partition_dir(directory, schema_name, table_name, day):
+    """封存檔目錄：<directory>/<table>/customer=<schema>/date=<YYYY-MM-DD>"""
+    return Path(directory) / table_name / f"customer={schema_name}" / f"date={day}"
+
+def arrow_type(column_type):
+    """PostgreSQL 欄位型別對應的 Arrow 型別，同一欄位在每個檔案都以相同型別寫入"""
+    column_type = column_type.upper()
+    if column_type.startswith("TIMESTAMP"):
+        return pa.timestamp("s")
+    if column_type in ("INTEGER", "BIGINT", "SMALLINT"):
+        return pa.int64()
+    if column_type in ("FLOAT", "DOUBLE PRECISION", "REAL") or column_type.startswith("NUMERIC"):
+        return pa.float64()
+    if column_type == "BOOLEAN":
+        return pa.bool_()
+    return pa.string()
+
+def infer_arrow_type(values):
+    """尚未登記型別的欄位：全為布林值存 bool，全為數字一律存 float64 (整數與小數不會分成兩種型別)，其餘存文字"""
+    samples = [value for value in values if value is not None]
+    if samples and all(isinstance(value, bool) for value in samples):
+        return pa.bool_()
+    if samples and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in samples):
+        return pa.float64()
+    return pa.string()
+
+def to_array(values, arrow_type):
+    if pa.types.is_timestamp(arrow_type):
+        strings = pa.array([None if value is None else str(value)[:19] for value in values], pa.string())
+        return pc.strptime(strings, format=TIME_FORMAT, unit="s", error_is_null=True)
+    if pa.types.is_string(arrow_type):
+        return pa.array([None if value is None else str(value) for value in values], pa.string())
+    try:
+        return pa.array(values, arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        # 值與登記的型別不符 (PostgreSQL 也寫不進這一欄)，這個檔案改存文字，讀取時統一成文字
+        return pa.array([None if value is None else str(value) for value in values], pa.string())
+
+def build_table(rows, column_type=column_type_for):
+    """資料列轉成 Arrow table
+
+    欄位為所有資料列欄位的聯集 (缺少的值為 null)。型別取自 column_type (欄位名稱 -> PostgreSQL 型別，
+    與資料庫的欄位型別一致)，尚未登記的欄位才依值決定；時間欄位轉成 timestamp 供時間範圍過濾。
+    依 serialnumber、collecttime 排序，同一設備的資料集中在少數 row group，統計值才能有效略過其他 row group。
+    """
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns.setdefault(key, None)
+
+    arrays = {}
+    for key in columns:
+        values = [row.get(key) for row in rows]
+        registered = "TIMESTAMP" if key == "collecttime" else column_type(key)  # 時間範圍過濾依賴 collecttime 的型別
+        arrays[key] = to_array(values, arrow_type(registered) if registered else infer_arrow_type(values))
+
+    table = pa.table(arrays)
+    sort_keys = [(column, "ascending") for column in STATISTICS_COLUMNS if column in arrays]
+    return table.sort_by(sort_keys) if sort_keys else table
+
+
+class ParquetSink(Sink):
+    """把資料列依 (schema, table, 日期) 累積後寫成壓縮的 Parquet 檔，供長期分析使用
+
+    sink 自己的執行緒在某個分組累積 rows_per_file 筆或最早的資料等待超過 flush_seconds 後寫檔
+    (先寫暫存檔再 rename，讀取端不會看到寫一半的檔案)。row group 統計值只記錄 serialnumber/collecttime。
+    欄位型別由 column_type (欄位名稱 -> PostgreSQL 型別) 決定，不隨每個檔案的內容改變。
+    緩衝筆數超過 max_pending 時丟棄新的資料並計數。
+    """
+
+    name = "parquet"
+
+    def __init__(self, directory, rows_per_file=100_000, row_group_size=10_000, flush_seconds=600,
+                 compression="zstd", max_pending=1_000_000, column_type=column_type_for):
+        require_pyarrow()
+        self.directory = Path(directory)
+        self.column_type = column_type
+        self.rows_per_file = rows_per_file
+        self.row_group_size = row_group_size
+        self.flush_seconds = flush_seconds
+        self.compression = compression
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.buffers = {}  # (schema, table, 日期) -> 資料列
+        self.first_row_times = {}  # (schema, table, 日期) -> 最早一筆的時間
+        self.size = 0  # 緩衝中與寫檔中的筆數
+        self.sequence = 0
+        self.ready = threading.Event()
+        self.force = False
+        self.closing = False
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="parquet-sink", daemon=True)
+        self.thread.start()
+
+    def write(self, schema_name, table_name, data):
+        collect_time = data.get("collecttime")
+        if collect_time is None:
+            metrics.increment("sink_rows_dropped_total", sink=self.name)
+            return
+
+        key = (schema_name, table_name, str(collect_time)[:10])
+        with self.lock:
+            if self.size >= self.max_pending:
+                metrics.increment("sink_rows_dropped_total", sink=self.name)
+                return
+            rows = self.buffers.get(key)
+            if rows is None:
+                rows = self.buffers[key] = []
+                self.first_row_times[key] = time.time()
+            rows.append(data)
+            self.size += 1
+            if len(rows) >= self.rows_per_file:
+                self.ready.set()
+
+    def flush(self, force=False):
+        if force:
+            self.force = True
+            self.ready.set()
+
+    def run(self):
+        while not self.closing:
+            self.ready.wait(min(self.flush_seconds, 5))
+            self.ready.clear()
+            force, self.force = self.force, False
+            self.write_due(force)
+
+    def write_due(self, force=False):
+        now = time.time()
+        with self.lock:
+            due = [key for key, rows in self.buffers.items()
+                   if force or len(rows) >= self.rows_per_file or now - self.first_row_times[key] >= self.flush_seconds]
+            batches = [(key, self.buffers.pop(key)) for key in due]
+            for key in due:
+                del self.first_row_times[key]
+
+        for key, rows in batches:
+            try:
+                with metrics.timer("archive_write_seconds"):
+                    self.write_file(key, rows)
+                metrics.increment("sink_rows_written_total", len(rows), sink=self.name)
+            except Exception as e:
+                metrics.increment("sink_rows_failed_total", len(rows), sink=self.name)
+                print(f"{datetime.now()} Failed to archive {len(rows)} rows of {key}: {e}")
+            finally:
+                with self.lock:
+                    self.size -= len(rows)
+
+    def write_file(self, key, rows):
+        schema_name, table_name, day = key
+        table = build_table(rows, self.column_type)
+
+        target_dir = partition_dir(self.directory, schema_name, table_name, day)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            self.sequence += 1
+            name = f"{time.time_ns():020d}-{self.sequence:06d}"
+        temp_path = target_dir / f"{name}.tmp"
+        try:
+            pq.write_table(table, temp_path, compression=self.compression, row_group_size=self.row_group_size,
+                           write_statistics=[column for column in STATISTICS_COLUMNS if column in table.column_names])
+            temp_path.rename(target_dir / f"{name}.parquet")
+        except Exception:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    def pending(self):
+        with self.lock:
+            return self.size
+
+    def close(self):
+        self.closing = True
+        self.ready.set()
+        self.thread.join()
+        self.write_due(force=True)
+
+
+def parse_time(value):
+    return datetime.strptime(value, TIME_FORMAT) if isinstance(value, str) else value
+
+def common_type(types):
+    """同一欄位在不同檔案的型別：相同時沿用，都是數字時用 float64，其餘用文字"""
+    types = {arrow_type for arrow_type in types if not pa.types.is_null(arrow_type)}
+    if not types:
+        return pa.string()
+    if len(types) == 1:
+        return next(iter(types))
+    if all(pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type) for arrow_type in types):
+        return pa.float64()
+    return pa.string()
+
+def unified_schema(paths, columns=None):
+    """所有檔案欄位的聯集 (只讀 footer)；指定但任何檔案都沒有的欄位以文字欄位補上 (值為 null)"""
+    types = {}
+    for path in paths:
+        for field in pq.read_schema(path):
+            types.setdefault(field.name, set()).add(field.type)
+    for column in columns or ():
+        types.setdefault(column, set())
+    return pa.schema([pa.field(name, common_type(found)) for name, found in types.items()])
+
+def read_archive(directory, schema_name, table_name="inverter", serial_numbers=None, start=None, end=None, columns=None):
+    """讀取封存的資料列，回傳 Arrow table
+
+    start/end 為 datetime 或 'YYYY-MM-DD HH:MM:SS'，範圍為 [start, end)。
+    先依目錄的日期略過整個檔案，再以 pyarrow.dataset 把 serialnumber/時間條件下推給 Parquet 讀取，
+    依 row group 統計值略過不可能符合的 row group。不同時期的檔案欄位可能不同 (新增欄位、型別不同)，
+    以 unified_schema 讀取：缺少的欄位為 null，型別不同的欄位轉成共同型別。
+    """
+    require_pyarrow()
+    start = parse_time(start)
+    end = parse_time(end)
+
+    paths = []
+    for day_dir in sorted((Path(directory) / table_name / f"customer={schema_name}").glob("date=*")):
+        day = day_dir.name.removeprefix("date=")
+        if start and day < start.date().isoformat():
+            continue
+        if end and day > end.date().isoformat():
+            continue
+        paths.extend(str(path) for path in sorted(day_dir.glob("*.parquet")))
+    if not paths:
+        return pa.table({})
+
+    conditions = []
+    if serial_numbers is not None:
+        conditions.append(pc.field("serialnumber").isin(list(serial_numbers)))
+    if start:
+        conditions.append(pc.field("collecttime") >= pa.scalar(start, pa.timestamp("s")))
+    if end:
+        conditions.append(pc.field("collecttime") < pa.scalar(end, pa.timestamp("s")))
+    filters = reduce(operator.and_, conditions) if conditions else None
+
+    dataset = ds.dataset(paths, schema=unified_schema(paths, columns), format="parquet")
+    return dataset.to_table(columns=columns, filter=filters)
+
+if __name__ == "__main__":
+    # 查詢封存資料：python archive.py <目錄> <schema> [--serial SN] [--start ...] [--end ...]
+    import argparse
+
+    parser = argparse.ArgumentParser(description="讀取 Parquet 封存資料")
+    parser.add_argument("directory")
+    parser.add_argument("schema")
+    parser.add_argument("--table", default="inverter")
+    parser.add_argument("--serial", action="append", help="可重複指定多台設備")
+    parser.add_argument("--start", help="'YYYY-MM-DD HH:MM:SS'")
+    parser.add_argument("--end", help="'YYYY-MM-DD HH:MM:SS' (不含)")
+    parser.add_argument("--columns", help="逗號分隔的欄位")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    result = read_archive(args.directory, args.schema, args.table, args.serial, args.start, args.end,
+                          args.columns.split(",") if args.columns else None)
+    print(result.slice(0, 10))
+    print(f"{result.num_rows} rows in {time.perf_counter() - started:.3f}s")
@@ -0,0 +1,399 @@
+"""端對端效能測試：以記憶體內的假 Kafka Consumer 把合成資料送進 consumer_worker
+
+    python benchmark.py                         # 所有情境，寫入 null sink (不需要 Kafka / PostgreSQL)
+    python benchmark.py --scenario alarm-burst  # 單一情境
+    python benchmark.py --database-url postgresql://user@localhost/bench --reset  # 寫入本機 PostgreSQL
+    python benchmark.py --influx --influx-delay 2  # 同時寫入本機模擬的 InfluxDB (每個請求延遲 2 秒)
+
+輸出每個情境的 msgs/sec、p50/p99 端對端延遲 (訊息可被消費 → offset 提交) 與 peak RSS。
+"""
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import os
+import random
+import resource
+import threading
+import time
+
+from confluent_kafka import TopicPartition
+from ecu_1051 import CleanECU1051, TIME_FIELDS, SERIAL_NUMBER_FIELDS, DEVICE_TYPE_FIELDS
+from modbus_mapping import ERROR_BITS
+
+BENCHMARK_SCHEMA_START = 990000  # 合成客戶 schema 編號從這裡開始，--reset 只會刪除這個範圍
+
+GOODWE_FIELDS = {
+    "pv1voltage": lambda: round(random.uniform(550, 650), 1),
+    "pv1current": lambda: round(random.uniform(0, 12), 2),
+    "pv2voltage": lambda: round(random.uniform(550, 650), 1),
+    "pv2current": lambda: round(random.uniform(0, 12), 2),
+    "vac1voltage": lambda: round(random.uniform(215, 235), 1),
+    "iac1current": lambda: round(random.uniform(0, 80), 2),
+    "fac1frequency": lambda: round(random.uniform(59.9, 60.1), 2),
+    "totalpower": lambda: round(random.uniform(0, 50), 2),
+    "dailyenergy": lambda: round(random.uniform(0, 300), 1),
+    "totalenergy": lambda: round(random.uniform(1e4, 1e6), 1),
+    "temperature": lambda: round(random.uniform(20, 70), 1),
+    "workmode": lambda: 1,
+    "warningcode": lambda: 0,
+    "functionbit": lambda: 0,
+}
+
+def goodwe_payload(serial_number, collect_time, error_code=0, extra_columns=0):
+    payload = {
+        "inverter_brand": "goodwe",
+        "devicetype": "GW50KN-MT",
+        "serialnumber": serial_number,
+        "collecttime": collect_time.strftime('%Y-%m-%d %H:%M:%S'),
+        "errormessage": error_code,
+    }
+    payload.update({key: value() for key, value in GOODWE_FIELDS.items()})
+    for index in range(extra_columns):
+        payload[f"extra{index}power"] = round(random.uniform(0, 10), 2)
+    return payload
+
+def register_words(text):
+    text = text.ljust(len(text) + len(text) % 2)
+    return [ord(text[i]) << 8 | ord(text[i + 1]) for i in range(0, len(text), 2)]
+
+def ecu_1051_payload(serial_number, collect_time):
+    """ECU-1051 原始 tag 格式，經 CleanECU1051 解析後送入 pipeline"""
+    fields = dict(zip(TIME_FIELDS, [collect_time.year - 2000, collect_time.month, collect_time.day,
+                                    collect_time.hour, collect_time.minute, collect_time.second]))
+    fields.update(zip(SERIAL_NUMBER_FIELDS, register_words(serial_number.ljust(16))))
+    fields.update(zip(DEVICE_TYPE_FIELDS, register_words("GW50KN-MT ")))
+    fields["gprsburninmode"] = 0
+    fields.update({key: value() for key, value in GOODWE_FIELDS.items()})
+    tags = [{"tag": f"ECU1051:{key.upper()}", "value": value} for key, value in fields.items()]
+    tags.append({"tag": "#MOBILE_IP", "value": "10.0.0.1"})
+    return tags
+
+def ecu_1051_messages(payloads):
+    records = CleanECU1051("ecu_1051").messages_to_records(payloads)
+    for record in records:
+        record["inverter_brand"] = "goodwe"
+        record["errormessage"] = 0
+    return records
+
+def scenario_messages(name, count, schemas, devices):
+    """回傳 [(topic, payload dict)]"""
+    start = datetime(2025, 1, 1)
+    messages = []
+
+    if name == "steady":
+        # 固定客戶數與欄位，大部分無告警；一半資料來自 ECU-1051 datalogger
+        ecu_payloads = []
+        for i in range(count):
+            topic = str(BENCHMARK_SCHEMA_START + i % schemas)
+            serial_number = f"GW{i % devices:014d}"
+            collect_time = start + timedelta(seconds=i // devices)
+            if i % 2:
+                ecu_payloads.append((topic, ecu_1051_payload(serial_number, collect_time)))
+            else:
+                messages.append((topic, goodwe_payload(serial_number, collect_time)))
+        decoded = ecu_1051_messages([payload for _, payload in ecu_payloads])
+        messages.extend((topic, record) for (topic, _), record in zip(ecu_payloads, decoded))
+
+    elif name == "new-schema-storm":
+        # 每則訊息都屬於新的客戶 schema
+        for i in range(count):
+            messages.append((str(BENCHMARK_SCHEMA_START + i), goodwe_payload(f"GW{i:014d}", start)))
+
+    elif name == "new-column-storm":
+        # 每個設備不斷回報新的欄位
+        for i in range(count):
+            topic = str(BENCHMARK_SCHEMA_START + i % schemas)
+            messages.append((topic, goodwe_payload(f"GW{i % devices:014d}", start + timedelta(seconds=i // devices),
+                                                   extra_columns=min(i // devices, 200))))
+
+    elif name == "alarm-burst":
+        # 電網事件：所有逆變器同時告警
+        for i in range(count):
+            topic = str(BENCHMARK_SCHEMA_START + i % schemas)
+            messages.append((topic, goodwe_payload(f"GW{i % devices:014d}", start + timedelta(seconds=i // devices),
+                                                   error_code=random.choice(ERROR_BITS) | random.choice(ERROR_BITS))))
+
+    else:
+        raise ValueError(f"unknown scenario: {name}")
+
+    return messages
+
+SCENARIOS = ("steady", "new-schema-storm", "new-column-storm", "alarm-burst")
+
+class FakeMessage:
+
+    def __init__(self, topic, partition, offset, value):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._value = value
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return self._value
+
+    def key(self):
+        return None
+
+    def error(self):
+        return None
+
+class FakeBroker:
+    """記憶體內的 topic/partition，consumer 依編號平均分配 partition"""
+
+    def __init__(self, messages, num_partitions, num_consumers):
+        self.lock = threading.Lock()
+        self.partitions = {}  # (topic, partition) -> [FakeMessage]
+        for topic, payload in messages:
+            partition = hash(payload.get("serialnumber")) % num_partitions  # 以 datalogger 作為 key
+            queue = self.partitions.setdefault((topic, partition), [])
+            queue.append(FakeMessage(topic, partition, len(queue), json.dumps(payload).encode("utf-8")))
+
+        self.total = len(messages)
+        self.num_consumers = num_consumers
+        self.next_consumer = 0
+        self.committed = 0
+        self.latencies = []
+
+    def assign(self):
+        with self.lock:
+            index = self.next_consumer
+            self.next_consumer += 1
+        return [key for i, key in enumerate(sorted(self.partitions)) if i % self.num_consumers == index]
+
+class FakeConsumer:
+    """實作 consumer_worker 用到的 confluent_kafka.Consumer 介面"""
+
+    broker = None
+
+    def __init__(self, config):
+        self.config = config
+        self.assigned = []
+        self.positions = {}
+        self.consumed_at = {}  # (topic, partition) -> 尚未提交的 [(offset, 取出時間)]
+        self.paused = set()
+
+    def subscribe(self, topics, on_assign=None, on_revoke=None):
+        self.assigned = self.broker.assign()
+        self.positions = {key: 0 for key in self.assigned}
+        if on_assign:
+            on_assign(self, self.assignment())
+
+    def consume(self, num_messages=1, timeout=-1):
+        messages = []
+        for key in self.assigned:
+            if key in self.paused:
+                continue
+            queue = self.broker.partitions[key]
+            position = self.positions[key]
+            batch = queue[position:position + num_messages - len(messages)]
+            messages.extend(batch)
+            self.positions[key] = position + len(batch)
+            if len(messages) >= num_messages:
+                break
+
+        if not messages:
+            time.sleep(min(timeout, 0.05))
+        else:
+            now = time.perf_counter()
+            for message in messages:
+                self.consumed_at.setdefault((message.topic(), message.partition()), []).append((message.offset(), now))
+        return messages
+
+    def commit(self, message=None, offsets=None, asynchronous=True):
+        """只把 offset 小於提交位置的訊息算作完成，與 Kafka 的提交語意相同"""
+        now = time.perf_counter()
+        if offsets is None:
+            offsets = [TopicPartition(topic, partition, self.positions[(topic, partition)]) for topic, partition in self.assigned]
+
+        for committed in offsets:
+            pending = self.consumed_at.get((committed.topic, committed.partition), [])
+            done = [consumed_at for offset, consumed_at in pending if offset < committed.offset]
+            self.consumed_at[(committed.topic, committed.partition)] = [entry for entry in pending if entry[0] >= committed.offset]
+            with self.broker.lock:
+                self.broker.latencies.extend(now - consumed_at for consumed_at in done)
+                self.broker.committed += len(done)
+
+    def assignment(self):
+        return [TopicPartition(topic, partition) for topic, partition in self.assigned]
+
+    def position(self, partitions):
+        return [TopicPartition(p.topic, p.partition, self.positions[(p.topic, p.partition)]) for p in partitions]
+
+    def get_watermark_offsets(self, partition, timeout=None, cached=False):
+        return 0, len(self.broker.partitions[(partition.topic, partition.partition)])
+
+    def pause(self, partitions):
+        self.paused.update((p.topic, p.partition) for p in partitions)
+
+    def resume(self, partitions):
+        self.paused.difference_update((p.topic, p.partition) for p in partitions)
+
+    def close(self):
+        pass
+
+class NullSink:
+    """取代資料庫寫入與 DDL，只記錄筆數，用來量測 pipeline 本身的成本"""
+
+    def __init__(self, kafka_handler):
+        self.kafka_handler = kafka_handler
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def apply_pending_columns(self, schema_name, table_name, columns):
+        tables = self.kafka_handler.column_cache.setdefault(schema_name, {})
+        for table in ("inverter", "alarm"):
+            tables.setdefault(table, {"id", "timestamp"})
+        tables[table_name] = tables[table_name] | set(columns)
+        self.kafka_handler.table_setup_done.add((schema_name, table_name))
+
+        self.kafka_handler.postgres_schemas.add(schema_name)
+
+    def flush_schema_groups(self, schema_name, groups):
+        with self.lock:
+            self.rows += sum(len(rows) for _, rows in groups)
+
+    def install(self):
+        self.kafka_handler.apply_pending_columns = self.apply_pending_columns
+        self.kafka_handler.flush_schema_groups = self.flush_schema_groups
+
+class InfluxStandIn:
+    """本機 HTTP 伺服器，模擬 InfluxDB 的 /api/v2/write，只計算收到的行數；delay 模擬緩慢的 InfluxDB"""
+
+    def __init__(self, delay=0.0):
+        stand_in = self
+        self.lines = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(delay)
+                with stand_in.lock:
+                    stand_in.requests += 1
+                    stand_in.lines += (body.count(b"\n") + 1) if body else 0
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, name="influx-stand-in", daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def reset_benchmark_schemas(kafka_handler):
+    from sqlalchemy import text
+    with kafka_handler.ddl_engine.begin() as connection:
+        schemas = [row[0] for row in connection.execute(text(f"""
+            SELECT nspname FROM pg_catalog.pg_namespace
+            WHERE nspname ~ '^[0-9]+$' AND nspname::bigint >= {BENCHMARK_SCHEMA_START}
+        """))]
+
+    for schema in schemas:
+        with kafka_handler.ddl_engine.begin() as connection:  # 每個 schema 各自一個交易，避免超過 lock 上限
+            connection.execute(text(f'DROP SCHEMA "{schema}" CASCADE'))
+    print(f"{datetime.now()} Dropped {len(schemas)} benchmark schemas")
+
+def run_scenario(kafka_handler, name, args, influx=None):
+    messages = scenario_messages(name, args.messages, args.schemas, args.devices)
+    broker = FakeBroker(messages, args.partitions, args.workers)
+    FakeConsumer.broker = broker
+
+    kafka_handler.Consumer = FakeConsumer
+    kafka_handler.kafka_topic_list = sorted({topic for topic, _ in messages})
+    kafka_handler.stop_event.clear()
+
+    started = time.perf_counter()
+    consumer_threads = kafka_handler.start_kafka_consumer(args.workers)
+
+    deadline = started + args.timeout
+    while broker.committed < broker.total and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    kafka_handler.stop_event.set()
+    for consumer_thread in consumer_threads:
+        consumer_thread.join()
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name:<18} {broker.committed:>8} msgs {broker.committed / elapsed:>10,.0f} msgs/s "
+          f"p50={percentile(broker.latencies, 0.5) * 1000:>8.1f}ms p99={percentile(broker.latencies, 0.99) * 1000:>8.1f}ms "
+          f"peak_rss={peak_rss_mb:.0f}MB")
+
+    if influx:
+        kafka_handler.flush_sinks(force=True)
+        print(f"{'':<18} influx stand-in received {influx.lines} lines in {influx.requests} requests, "
+              f"{sum(sink.pending() for sink in kafka_handler.sinks)} pending")
+
+    if broker.committed < broker.total:
+        print(f"{name}: timed out after {args.timeout}s with {broker.total - broker.committed} messages uncommitted")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append", help="預設執行全部情境")
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--schemas", type=int, default=20, help="客戶 schema 數量")
+    parser.add_argument("--devices", type=int, default=200, help="每個情境的逆變器數量")
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=1, help="consumer worker 數量")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--linger", type=float, default=0.2, help="批次最長等待秒數")
+    parser.add_argument("--timeout", type=float, default=300, help="每個情境最長執行秒數")
+    parser.add_argument("--database-url", help="寫入此 PostgreSQL；未指定時使用 null sink")
+    parser.add_argument("--reset", action="store_true", help="執行前刪除先前的 benchmark schemas")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--influx", action="store_true", help="同時寫入本機模擬的 InfluxDB")
+    parser.add_argument("--influx-delay", type=float, default=0.0, help="模擬的 InfluxDB 每個請求延遲秒數")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    # kafka_handler 在 import 時讀取設定並建立 engine (不會立即連線)
+    os.environ["DATABASE_URL"] = args.database_url or "postgresql://benchmark@localhost/benchmark"
+    os.environ["BATCH_SIZE"] = str(args.batch_size)
+    os.environ["BATCH_LINGER_SECONDS"] = str(args.linger)
+    os.environ.setdefault("METRICS_LOG_INTERVAL", "3600")
+    influx = None
+    if args.influx:
+        influx = InfluxStandIn(args.influx_delay)
+        os.environ.update(SINKS="influxdb", INFLUXDB_URL=influx.url, INFLUXDB_TOKEN="benchmark",
+                          INFLUXDB_ORG="benchmark", INFLUXDB_BUCKET="benchmark")
+    import kafka_handler
+
+    if args.database_url:
+        if args.reset:
+            reset_benchmark_schemas(kafka_handler)
+        kafka_handler.list_postgres_schemas()
+        kafka_handler.check_and_update_schema_tables()
+    else:
+        NullSink(kafka_handler).install()
+
+    for name in args.scenario or SCENARIOS:
+        run_scenario(kafka_handler, name, args, influx)
+
+    if influx:
+        kafka_handler.close_sinks()
+        print(f"influx stand-in received {influx.lines} lines in {influx.requests} requests after close")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import json
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:  # 未安裝時退回標準庫 json
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+DECODERS = ("auto", "orjson", "msgspec", "json")
+
+def get_decoder(name="auto"):
+    """回傳直接從 bytes/memoryview 解析 JSON 的函式
+
+    auto 依序選用 orjson、msgspec，都未安裝時使用標準庫 json (json.loads 也接受 bytes，
+    不必先 decode 成 str)。
+    """
+    if name not in DECODERS:
+        raise ValueError(f"Unknown JSON decoder '{name}', expected one of {DECODERS}")
+
+    if name in ("auto", "orjson") and orjson is not None:
+        return "orjson", orjson.loads
+    if name in ("auto", "msgspec") and msgspec is not None:
+        return "msgspec", msgspec.json.Decoder(dict).decode
+    if name != "auto" and name != "json":
+        print(f"{datetime.now()} JSON decoder '{name}' is not installed, falling back to json")
+    return "json", json.loads
+
+def decode_payload(loads, raw):
+    """解析一則逆變器訊息，回傳 (inverter_brand, devicetype, data)
+
+    inverter_brand/devicetype 不寫入資料表，直接從 dict 取出；
+    errormessage 若以字串傳送則在此轉成整數，之後的路由只需比較 int。
+    """
+    data = loads(raw)
+
+    inverter_brand = data.pop("inverter_brand", None)
+    inverter_devicetype = data.pop("devicetype", None)
+
+    error_message = data.get("errormessage")
+    if isinstance(error_message, str):
+        data["errormessage"] = int(error_message or 0)
+
+    return inverter_brand, inverter_devicetype, data
+
+if __name__ == "__main__":
+    # 各解析器的效能比較
+    import random
+    import timeit
+
+    def sample_payload(i):
+        payload = {"inverter_brand": "goodwe", "devicetype": "GW50KN-MT", "serialnumber": f"GW{i:014d}",
+                   "collecttime": "2025-01-01 00:00:00", "errormessage": 0}
+        payload.update({f"register{n}": round(random.uniform(0, 1000), 2) for n in range(60)})
+        return json.dumps(payload).encode("utf-8")
+
+    payloads = [sample_payload(i) for i in range(10_000)]
+    rounds = 5
+
+    baseline = timeit.timeit(lambda: [json.loads(raw.decode("utf-8")) for raw in payloads], number=rounds) / rounds
+    print(f"json (decode + loads): {len(payloads) / baseline:,.0f} msgs/s")
+
+    for name, module in (("orjson", orjson), ("msgspec", msgspec), ("json", json)):
+        if module is None:
+            continue
+        _, loads = get_decoder(name)
+        assert [loads(raw) for raw in payloads] == [json.loads(raw) for raw in payloads]
+        elapsed = timeit.timeit(lambda: [decode_payload(loads, raw) for raw in payloads], number=rounds) / rounds
+        print(f"{name:<21} {len(payloads) / elapsed:,.0f} msgs/s ({baseline / elapsed:.1f}x)")
@@ -1,4 +1,23 @@
 from datetime import datetime
+import struct
+
+TIME_FIELDS = ("year", "month", "date", "hour", "minute", "second")
+SERIAL_NUMBER_FIELDS = tuple(f"deviceserialnumber{i}" for i in range(1, 9))
+DEVICE_TYPE_FIELDS = tuple(f"devicetype{i}" for i in range(1, 6))
+
+# tag -> 欄位名稱，同一種 tag 只需解析一次 (None 代表忽略的 tag)
+TAG_FIELD_CACHE = {'#MOBILE_IP': None}
+
+def tag_to_field(tag):
+    if tag not in TAG_FIELD_CACHE:
+        TAG_FIELD_CACHE[tag] = tag.split(':')[1].lower()
+    return TAG_FIELD_CACHE[tag]
+
+def decode_register_strings(words, words_per_value):
+    """把多筆暫存器 word 一次轉成 bytes，再依每筆的 word 數切成字串 (每個 word 為高、低兩個字元)"""
+    raw = struct.pack(f">{len(words)}H", *words).decode("latin-1")
+    width = words_per_value * 2
+    return [raw[i:i + width] for i in range(0, len(raw), width)]
 
 
 class CleanECU1051:
@@ -56,4 +75,75 @@ class CleanECU1051:
         dict["gprsburninmode"] = dict["gprsburninmode"]
         dict.pop("gprsburninmode")
 
-        return dict
\ No newline at end of file
+        return dict
+
+    def messages_to_records(self, payloads, columnar=False):
+        """批次解析多筆 ECU-1051 訊息
+
+        時間、序號與設備型號以欄為單位一次轉換，不再逐筆呼叫 strftime / hex_to_ascii。
+        回傳與 message_to_dict 相同的 dict list；columnar=True 時回傳 {欄位: 值 list}，可直接批次寫入。
+        """
+        rows = []
+        for data in payloads:
+            row = {}
+            for entry in data:
+                key = tag_to_field(entry['tag'])
+                if key is not None:
+                    row[key] = entry['value']
+            rows.append(row)
+
+        collect_times = [
+            "%04d-%02d-%02d %02d:%02d:%02d" % (2000 + int(year), int(month), int(date), int(hour), int(minute), int(second))
+            for year, month, date, hour, minute, second in ([row.pop(k) for k in TIME_FIELDS] for row in rows)
+        ]
+        serial_numbers = decode_register_strings(
+            [int(row.pop(k)) for row in rows for k in SERIAL_NUMBER_FIELDS], len(SERIAL_NUMBER_FIELDS)
+        )
+        device_types = decode_register_strings(
+            [int(row.pop(k)) for row in rows for k in DEVICE_TYPE_FIELDS], len(DEVICE_TYPE_FIELDS)
+        )
+
+        for row, collect_time, serial_number, devicetype in zip(rows, collect_times, serial_numbers, device_types):
+            row["collecttime"] = collect_time
+            row["serialnumber"] = serial_number
+            row["devicetype"] = devicetype
+            row.pop("gprsburninmode")
+
+        if not columnar:
+            return rows
+
+        columns = {}
+        for row in rows:
+            for key in row:
+                columns.setdefault(key, None)
+        return {key: [row.get(key) for row in rows] for key in columns}
+
+
+if __name__ == "__main__":
+    # 批次解析與逐筆解析的效能比較
+    import random
+    import timeit
+
+    def sample_payload():
+        words = lambda text: [ord(text[i]) << 8 | ord(text[i + 1]) for i in range(0, len(text), 2)]
+        serial_number = "".join(random.choice("ABCDEFGHJKLMNPQRSTUVWXYZ0123456789") for _ in range(16))
+        fields = dict(zip(TIME_FIELDS, [25, random.randint(1, 12), random.randint(1, 28),
+                                        random.randint(0, 23), random.randint(0, 59), random.randint(0, 59)]))
+        fields.update(zip(SERIAL_NUMBER_FIELDS, words(serial_number)))
+        fields.update(zip(DEVICE_TYPE_FIELDS, words("GW50KN-MT ")))
+        fields.update({"gprsburninmode": 0, "workmode": 1, "pv1voltage": 612.3, "pv1current": 8.1, "totalpower": 49.8})
+        payload = [{"tag": f"ECU1051:{key.upper()}", "value": value} for key, value in fields.items()]
+        payload.append({"tag": "#MOBILE_IP", "value": "10.0.0.1"})
+        return payload
+
+    ecu = CleanECU1051("ecu_1051")
+    payloads = [sample_payload() for _ in range(10_000)]
+
+    assert ecu.messages_to_records(payloads) == [ecu.message_to_dict(payload) for payload in payloads]
+
+    rounds = 5
+    per_message = timeit.timeit(lambda: [ecu.message_to_dict(payload) for payload in payloads], number=rounds) / rounds
+    batch = timeit.timeit(lambda: ecu.messages_to_records(payloads), number=rounds) / rounds
+
+    print(f"per-message: {len(payloads) / per_message:,.0f} msgs/s")
+    print(f"batch:       {len(payloads) / batch:,.0f} msgs/s ({per_message / batch:.1f}x)")
\ No newline at end of file
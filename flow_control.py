@@ -0,0 +1,79 @@
+class FlowController:
+    """依下游寫入狀況調整消費速度
+
+    - 批次大小：批次延遲 (第一筆進入緩衝到寫入完成，EWMA) 低於目標一半且上一批是因為滿了才寫入時放大，
+      超過目標時縮小。
+    - linger：目標延遲扣掉寫入耗時，讓「等待 + 寫入」接近目標，流量低時不會多等。
+    - pause/resume：尚未落地的資料列 (OffsetTracker 中未完成的筆數) 超過上限的 partition 暫停，
+      降到上限一半以下才恢復；全部合計超過上限時暫停所有 partition。
+    """
+
+    def __init__(self, target_latency, batch_size, min_batch_size, max_batch_size, linger_seconds,
+                 min_linger_seconds, max_linger_seconds, max_in_flight, max_partition_in_flight, smoothing=0.3):
+        self.target_latency = target_latency
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.linger_seconds = linger_seconds
+        self.min_linger_seconds = min_linger_seconds
+        self.max_linger_seconds = max_linger_seconds
+        self.max_in_flight = max_in_flight
+        self.max_partition_in_flight = max_partition_in_flight
+        self.smoothing = smoothing
+        self.latency = None  # 批次延遲的 EWMA (秒)
+        self.write_seconds = None  # 寫入耗時的 EWMA (秒)
+        self.paused = set()  # 因積壓而暫停的 (topic, partition)
+        self.overloaded = False  # 全部合計超過上限，所有 partition 都暫停
+
+    def smooth(self, average, value):
+        return value if average is None else average + self.smoothing * (value - average)
+
+    def record_flush(self, rows, latency, write_seconds, full):
+        """記錄一次寫入：rows 筆，第一筆進入緩衝到寫入完成共 latency 秒，其中寫入耗時 write_seconds 秒
+
+        full 表示這批是因為達到批次大小而寫入。
+        """
+        if not rows:
+            return
+        self.latency = self.smooth(self.latency, latency)
+        self.write_seconds = self.smooth(self.write_seconds, write_seconds)
+
+        if self.latency > self.target_latency:
+            self.batch_size = max(self.min_batch_size, int(self.batch_size * 0.75))
+        elif full and self.latency < self.target_latency / 2:
+            self.batch_size = min(self.max_batch_size, int(self.batch_size * 1.25) + 1)
+
+        self.linger_seconds = min(self.max_linger_seconds,
+                                  max(self.min_linger_seconds, self.target_latency - self.write_seconds))
+
+    def partitions_to_toggle(self, in_flight, assignment, hold_all=False):
+        """依各 partition 尚未落地的筆數回傳 (要暫停的, 要恢復的) (topic, partition) 列表
+
+        in_flight 為 {(topic, partition): 筆數}，assignment 為目前分配到的 (topic, partition)；
+        已被收回的 partition 不再視為暫停中。hold_all 為 True 時 (例如 spill 已滿) 暫停所有 partition。
+        """
+        assigned = set(assignment)
+        self.paused &= assigned
+
+        total = sum(in_flight.values())
+        if total >= self.max_in_flight:
+            self.overloaded = True
+        elif total <= self.max_in_flight / 2:
+            self.overloaded = False
+
+        wanted = set()
+        for key in assigned:
+            rows = in_flight.get(key, 0)
+            if hold_all or self.overloaded or rows >= self.max_partition_in_flight:
+                wanted.add(key)
+            elif key in self.paused and rows > self.max_partition_in_flight / 2:
+                wanted.add(key)  # 降到一半以下才恢復，避免頻繁切換
+
+        to_pause = sorted(wanted - self.paused)
+        to_resume = sorted(self.paused - wanted)
+        self.paused = wanted
+        return to_pause, to_resume
+
+    def forget(self, keys):
+        """partition 被收回後不再視為暫停中 (重新分配時 Kafka 不會保留暫停狀態)"""
+        self.paused.difference_update(keys)
@@ -1,21 +1,39 @@
-from confluent_kafka import Consumer
+from confluent_kafka import Consumer, Producer, TopicPartition
 from dotenv import load_dotenv
-from influxdb_client import InfluxDBClient, Point, WriteOptions
 import time
 import os
 import json
-from datetime import datetime
+import csv
+import io
+import base64
+from datetime import datetime, date, timedelta
+from functools import lru_cache
+from collections import OrderedDict
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine, MetaData, Table, Column, String, Integer, Float, DateTime, text, func
+from sqlalchemy.sql import table as table_clause, column as column_clause
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.inspection import inspect
-from modbus_mapping import GoodWe
-# import queue
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import exc as sqlalchemy_exc
+from modbus_mapping import ERROR_BITS, goodwe_for, column_type_for, TEXT_TYPE
+import queue
+import heapq
 import threading
 import concurrent.futures
 from ecu_1051 import CleanECU1051
 from pathlib import Path
 from confluent_kafka.admin import AdminClient, NewTopic
 from confluent_kafka import KafkaException
+import metrics
+from decoder import get_decoder, decode_payload
+from offset_tracker import OffsetTracker
+from flow_control import FlowController
+from alarm_tracker import AlarmTracker
+from rollups import ROLLUP_INTERVALS, accumulate, create_rollup_tables, rollup_fields, upsert_rollups
+from spill import SpillStore, SpillFull
+from sinks import InfluxSink
+from archive import ParquetSink
 import random
 from concurrent.futures import ThreadPoolExecutor
 
@@ -24,22 +42,345 @@ load_dotenv()
 KAFKA_BROKER = os.getenv('KAFKA_BROKER')
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-
-engine = create_engine(DATABASE_URL)
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 500))  # 每批最多寫入筆數
+BATCH_LINGER_SECONDS = float(os.getenv("BATCH_LINGER_SECONDS", 1.0))  # 批次最長等待秒數
+STATEMENT_CACHE_SIZE = int(os.getenv("STATEMENT_CACHE_SIZE", 1024))  # INSERT 語句快取上限
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", 1))  # 同一 consumer group 內的 consumer 執行緒數量
+DB_WRITE_CONCURRENCY = int(os.getenv("DB_WRITE_CONCURRENCY", 8))  # 不同 schema 可同時進行的批次寫入數
+WRITE_POLL_SECONDS = float(os.getenv("WRITE_POLL_SECONDS", 0.05))  # 有寫入中的批次時，consumer 多久檢查一次是否完成
+DDL_WORKERS = int(os.getenv("DDL_WORKERS", 2))  # 背景執行 schema/欄位 DDL 的執行緒數量
+KAFKA_NUM_PARTITIONS = int(os.getenv("KAFKA_NUM_PARTITIONS", 1))  # 新建 topic 的 partition 數量
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # >0 時在此 port 提供 Prometheus /metrics
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", 60))  # 每隔幾秒輸出一行指標摘要
+LAG_REPORT_INTERVAL = int(os.getenv("LAG_REPORT_INTERVAL", 30))  # 每隔幾秒更新 consumer lag
+PARTITIONED_TABLES = os.getenv("PARTITIONED_TABLES", "false").lower() == "true"  # 新建的 inverter/alarm 依 collecttime 分區
+PARTITION_PREMAKE_DAYS = int(os.getenv("PARTITION_PREMAKE_DAYS", 7))  # 預先建立未來幾天的分區
+PARTITION_RETENTION_DAYS = int(os.getenv("PARTITION_RETENTION_DAYS", 0))  # 保留天數，0 表示永久保留
+PARTITION_RETENTION_ACTION = os.getenv("PARTITION_RETENTION_ACTION", "detach")  # 過期分區 "detach" 或 "drop"
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", 3600))
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", 200_000))  # 記憶體內最近寫入鍵的數量上限，0 表示關閉
+PG_INGEST_MODE = os.getenv("PG_INGEST_MODE", "insert")  # "insert" 多筆 INSERT / "copy" COPY 批量匯入 (回補資料時使用)
+FLUSH_MAX_RETRIES = int(os.getenv("FLUSH_MAX_RETRIES", 5))  # 同一分組連續寫入失敗幾次後移出 schema 交易單獨寫入，找出寫不進去的資料列
+DEAD_LETTER_TOPIC = os.getenv("DEAD_LETTER_TOPIC", "")  # 無法寫入的資料送往此 topic，未設定 (或送出失敗) 時寫入 REJECT_FILE
+REJECT_FILE = os.getenv("REJECT_FILE", "rejected_rows.jsonl")  # 無法寫入的資料列與無法解析的訊息以 JSON lines 附加到此檔案
+KAFKA_TOPIC_PATTERN = os.getenv("KAFKA_TOPIC_PATTERN", "^[0-9]+$")  # 以 regex 訂閱所有客戶 topic
+TOPIC_METADATA_REFRESH_MS = int(os.getenv("TOPIC_METADATA_REFRESH_MS", 10_000))  # consumer 多久比對一次 metadata 找出新 topic
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", DB_WRITE_CONCURRENCY))  # 寫入 (DML) 連線池常駐連線數
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 2))  # 寫入連線池可臨時多開的連線數
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # 等待可用連線的秒數上限
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # 連線使用超過幾秒後重建，-1 表示不重建
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 30_000))  # 寫入語句逾時，0 表示不限制
+DDL_POOL_SIZE = int(os.getenv("DDL_POOL_SIZE", DDL_WORKERS + 1))  # DDL 連線池常駐連線數 (DDL worker + 分區維護)
+DDL_LOCK_TIMEOUT_MS = int(os.getenv("DDL_LOCK_TIMEOUT_MS", 5_000))  # DDL 等待表鎖的上限，逾時由 DDL worker 稍後重試
+DDL_MAX_RETRIES = int(os.getenv("DDL_MAX_RETRIES", 5))  # 新增欄位連續失敗幾次後放棄，等待這些欄位的資料列送往 dead-letter/reject 檔
+DDL_RETRY_SECONDS = float(os.getenv("DDL_RETRY_SECONDS", 5))  # DDL 失敗後第一次重試前等待秒數 (之後每次加倍)
+DDL_FAILURE_TTL = int(os.getenv("DDL_FAILURE_TTL", 600))  # 放棄的欄位多久之後允許新的資料列再次嘗試新增
+JSON_DECODER = os.getenv("JSON_DECODER", "auto")  # "auto" / "orjson" / "msgspec" / "json"
+ALARM_LIFECYCLE = os.getenv("ALARM_LIFECYCLE", "true").lower() == "true"  # 依錯誤 bit 變化開啟/解除告警，告警持續期間不重複寫入
+ALARM_REBUILD_DAYS = int(os.getenv("ALARM_REBUILD_DAYS", 7))  # 啟動時載入幾天內未解除的告警
+TYPE_SAMPLE_SIZE = int(os.getenv("TYPE_SAMPLE_SIZE", 8))  # 未知欄位最多收集幾個樣本值再決定型別
+ROLLUPS = os.getenv("ROLLUPS", "true").lower() == "true"  # 寫入時同時更新 inverter_5m/1h/1d 彙總表
+SPILL_DIR = os.getenv("SPILL_DIR", "")  # 資料庫無法寫入時暫存批次的目錄，未設定時不使用 spill
+SPILL_MAX_BYTES = int(os.getenv("SPILL_MAX_BYTES", 1024 ** 3))  # spill 大小上限，達到時暫停消費；0 表示關閉 spill
+SPILL_DRAIN_INTERVAL = float(os.getenv("SPILL_DRAIN_INTERVAL", 5))  # 資料庫仍無法寫入時，drainer 多久重試一次
+SPILL_DRAIN_BATCH = int(os.getenv("SPILL_DRAIN_BATCH", 50))  # drainer 每個交易最多合併幾個 segment
+SINKS = [name.strip() for name in os.getenv("SINKS", "").split(",") if name.strip()]  # PostgreSQL 以外同時寫入的目的地："influxdb"、"parquet"
+INFLUXDB_URL = os.getenv("INFLUXDB_URL")
+INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
+INFLUXDB_ORG = os.getenv("INFLUXDB_ORG")
+INFLUXDB_BUCKET = os.getenv("INFLUXDB_BUCKET")
+INFLUX_BATCH_SIZE = int(os.getenv("INFLUX_BATCH_SIZE", 5000))  # 每次寫入 InfluxDB 的最多行數
+INFLUX_FLUSH_INTERVAL_MS = int(os.getenv("INFLUX_FLUSH_INTERVAL_MS", 1000))  # 未滿一批時最長等待毫秒數
+INFLUX_RETRY_INTERVAL_MS = int(os.getenv("INFLUX_RETRY_INTERVAL_MS", 5000))  # 第一次重試前等待毫秒數 (之後指數退避)
+INFLUX_MAX_RETRIES = int(os.getenv("INFLUX_MAX_RETRIES", 5))  # 同一批最多重試次數，之後丟棄並計數
+INFLUX_MAX_PENDING = int(os.getenv("INFLUX_MAX_PENDING", 500_000))  # 尚未送達的行數上限，超過時丟棄新資料
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", str(Path(__file__).resolve().parent / "archive"))  # Parquet 封存目錄 (需要 pyarrow)
+ARCHIVE_ROWS_PER_FILE = int(os.getenv("ARCHIVE_ROWS_PER_FILE", 100_000))  # 每個 (schema, table, 日期) 累積幾筆寫成一個檔案
+ARCHIVE_ROW_GROUP_SIZE = int(os.getenv("ARCHIVE_ROW_GROUP_SIZE", 10_000))  # 每個 row group 的筆數
+ARCHIVE_FLUSH_SECONDS = float(os.getenv("ARCHIVE_FLUSH_SECONDS", 600))  # 未滿一個檔案時最長等待秒數
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "zstd")  # "zstd" / "snappy" / "gzip" / "none"
+ARCHIVE_MAX_PENDING = int(os.getenv("ARCHIVE_MAX_PENDING", 1_000_000))  # 緩衝筆數上限，超過時丟棄新資料
+FLOW_CONTROL = os.getenv("FLOW_CONTROL", "true").lower() == "true"  # 依寫入延遲調整批次大小/linger，積壓時暫停 partition
+FLOW_TARGET_LATENCY_MS = int(os.getenv("FLOW_TARGET_LATENCY_MS", 500))  # 目標寫入延遲 (等待 + 寫入)
+MIN_BATCH_SIZE = int(os.getenv("MIN_BATCH_SIZE", max(BATCH_SIZE // 10, 1)))  # 動態批次大小下限
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", BATCH_SIZE * 10))  # 動態批次大小上限
+MIN_LINGER_SECONDS = float(os.getenv("MIN_LINGER_SECONDS", 0.05))  # 動態 linger 下限，上限為 BATCH_LINGER_SECONDS
+MAX_IN_FLIGHT_ROWS = int(os.getenv("MAX_IN_FLIGHT_ROWS", 100_000))  # 每個 consumer 尚未落地的資料列上限，超過時暫停所有 partition
+MAX_PARTITION_IN_FLIGHT_ROWS = int(os.getenv("MAX_PARTITION_IN_FLIGHT_ROWS", 20_000))  # 單一 partition 尚未落地的資料列上限
+KAFKA_FETCH_MIN_BYTES = int(os.getenv("KAFKA_FETCH_MIN_BYTES", 1))  # broker 累積多少資料才回應 fetch
+KAFKA_FETCH_WAIT_MAX_MS = int(os.getenv("KAFKA_FETCH_WAIT_MAX_MS", 500))  # 未達 fetch.min.bytes 時 broker 最多等待毫秒數
+KAFKA_MAX_PARTITION_FETCH_BYTES = int(os.getenv("KAFKA_MAX_PARTITION_FETCH_BYTES", 1024 * 1024))  # 每個 partition 每次 fetch 的上限
+KAFKA_QUEUED_MAX_KBYTES = int(os.getenv("KAFKA_QUEUED_MAX_KBYTES", 64 * 1024))  # consumer 本地預取佇列上限 (KB)
+
+
+def timed_pool_class(pool_name):
+    """記錄每次取得連線的等待時間與次數的 QueuePool"""
+
+    class TimedQueuePool(QueuePool):
+
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                metrics.observe("db_pool_wait_seconds", time.perf_counter() - started, pool=pool_name)
+                metrics.increment("db_pool_checkouts_total", pool=pool_name)
+
+    return TimedQueuePool
+
+def create_pooled_engine(pool_name, pool_size, max_overflow, options):
+    """options 為連線時設定的 PostgreSQL 參數 (例如 statement_timeout)"""
+    return create_engine(
+        DATABASE_URL,
+        poolclass=timed_pool_class(pool_name),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,  # 資料庫重啟或閒置斷線後自動換新連線
+        connect_args={"options": " ".join(f"-c {key}={value}" for key, value in options.items())},
+    )
+
+# 寫入與 DDL 使用各自的連線池，DDL 等鎖或大量新客戶建表時不會佔滿寫入的連線
+engine = create_pooled_engine("dml", DB_POOL_SIZE, DB_MAX_OVERFLOW,
+                              {"statement_timeout": DB_STATEMENT_TIMEOUT_MS})
+ddl_engine = create_pooled_engine("ddl", DDL_POOL_SIZE, 2,
+                                  {"statement_timeout": 0, "lock_timeout": DDL_LOCK_TIMEOUT_MS})
 Session = sessionmaker(bind=engine)
 
-# INFLUXDB_URL = os.getenv("INFLUXDB_URL")
-# INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
-# INFLUXDB_ORG = os.getenv("INFLUXDB_ORG")
-# INFLUXDB_BUCKET = os.getenv("INFLUXDB_BUCKET")
+def pool_metrics():
+    collected = {}
+    for pool_name, pooled_engine in (("dml", engine), ("ddl", ddl_engine)):
+        labels = (("pool", pool_name),)
+        collected[("db_pool_checked_out", labels)] = pooled_engine.pool.checkedout()
+        collected[("db_pool_size", labels)] = pooled_engine.pool.size() + max(pooled_engine.pool.overflow(), 0)
+    return collected
+
+metrics.register_collector(pool_metrics)
+
+def registered_column_type(key):
+    """已決定的 PostgreSQL 欄位型別 (modbus_mapping 型別表或 column_type_cache)，尚未決定時回傳 None"""
+    return column_type_for(key) or column_type_cache.get(key)
+
+def build_sinks():
+    """依 SINKS 建立 PostgreSQL 以外的 sink；PostgreSQL 一律寫入，並決定 offset 何時可以提交"""
+    built = []
+    for name in SINKS:
+        if name == "influxdb":
+            built.append(InfluxSink(INFLUXDB_URL, INFLUXDB_TOKEN, INFLUXDB_ORG, INFLUXDB_BUCKET,
+                                    batch_size=INFLUX_BATCH_SIZE, flush_interval_ms=INFLUX_FLUSH_INTERVAL_MS,
+                                    retry_interval_ms=INFLUX_RETRY_INTERVAL_MS, max_retries=INFLUX_MAX_RETRIES,
+                                    max_pending=INFLUX_MAX_PENDING))
+        elif name == "parquet":
+            built.append(ParquetSink(ARCHIVE_DIR, rows_per_file=ARCHIVE_ROWS_PER_FILE, row_group_size=ARCHIVE_ROW_GROUP_SIZE,
+                                     flush_seconds=ARCHIVE_FLUSH_SECONDS, compression=ARCHIVE_COMPRESSION,
+                                     max_pending=ARCHIVE_MAX_PENDING, column_type=registered_column_type))
+        else:
+            raise ValueError(f"Unknown sink '{name}' in SINKS")
+    return built
+
+sinks = build_sinks()
+
+def flush_sinks(force=False):
+    """要求各 sink 的背景執行緒送出緩衝中的資料，不等待寫入完成；單一 sink 出錯不影響其他 sink"""
+    for sink in sinks:
+        try:
+            sink.flush(force)
+        except Exception as e:
+            print(f"{datetime.now()} Failed to flush {sink.name} sink: {e}")
+
+def close_sinks():
+    for sink in sinks:
+        try:
+            sink.close()
+        except Exception as e:
+            print(f"{datetime.now()} Failed to close {sink.name} sink: {e}")
+
+def sink_metrics():
+    return {("sink_pending_rows", (("sink", sink.name),)): sink.pending() for sink in sinks}
 
-# client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
-# write_api = client.write_api(write_options=WriteOptions(batch_size=1000, flush_interval=10_000))
+metrics.register_collector(sink_metrics)
 
 kafka_topic_list = []
-postgres_schema_list = []
+postgres_schemas = set()  # 已存在的客戶 schema
+
+admin_client = None  # 共用的 AdminClient，避免每次查詢都重新建立連線
+admin_client_lock = threading.Lock()
+known_topics = set()  # 已確認存在的 Kafka topic
 
 column_cache = {}
+index_cache = set()  # 已存在的 (schema, index 名稱)
+constraint_cache = set()  # 已存在的 (schema, constraint 名稱)
+column_cache_stats = {"hits": 0, "misses": 0}
+
+# 每台設備每個 collecttime 只保留一筆：資料庫唯一約束與記憶體去重都以此為鍵
+DEDUP_COLUMNS = ("serialnumber", "collecttime")
+# 告警解除在緩衝區中的分組名稱，寫入時以 UPDATE alarm 執行，欄位檢查沿用 alarm 表
+ALARM_RESOLUTION = "alarm_resolution"
+partitioned_tables = set()  # 依 collecttime 分區的 (schema, table)
+partition_cache = set()  # 已建立的 (schema, table, 日期) 分區
+rollup_tables = set()  # 已建立彙總表的 schema
+
+# 待新增欄位 {(schema, table): {欄位: [非 None 樣本值]}}，由 DDL worker 合併成一個 ALTER TABLE
+pending_columns = {}
+# 未知欄位第一次決定的型別，所有 schema 共用，同名欄位在每個客戶都是相同型別
+column_type_cache = {}
+pending_columns_lock = threading.Lock()
+# 放棄新增的欄位 {(schema, table): {欄位: (錯誤訊息, 放棄時間)}}，含這些欄位的資料列不再等待 DDL
+failed_columns = {}
+# 待建立的分區 {(schema, table): {日期}}，與 pending_columns 一起由 DDL worker 處理
+pending_partitions = {}
+failed_partitions = {}  # 放棄建立的分區 {(schema, table): {日期: (錯誤訊息, 放棄時間)}}
+ddl_failures = {}  # (schema, table) -> DDL 連續失敗次數
+# 同一個 schema 固定交給同一個 DDL worker，DDL 依序執行且不會卡住其他 schema
+ddl_queues = [queue.Queue() for _ in range(DDL_WORKERS)]
+ddl_threads = []
+table_setup_done = set()  # 已建立 index/constraint 的 (schema, table)
+# (schema, table) -> DDL worker 處理完成 (或放棄) 的次數，暫存的資料列只在對應的表有變化後才重新檢查
+ddl_versions = {}
+
+stop_event = threading.Event()  # 設定後 consumer worker 寫完剩餘資料並結束
+
+json_decoder_name, decode_json = get_decoder(JSON_DECODER)
+
+spill_store = None  # 設定 SPILL_DIR 時由 start_kafka_consumer 建立
+
+db_write_executor = ThreadPoolExecutor(max_workers=DB_WRITE_CONCURRENCY, thread_name_prefix="db-writer")
+
+dead_letter_producer = None
+dead_letter_lock = threading.Lock()
+reject_file_lock = threading.Lock()
+
+class RowBuffer:
+    """依 (schema, table, 欄位組合) 分組暫存資料列，達到批次大小或等待上限時再一次寫入"""
+
+    def __init__(self, batch_size=BATCH_SIZE, linger_seconds=BATCH_LINGER_SECONDS, offset_tracker=None):
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+        self.groups = {}
+        self.sources = {}  # 與 groups 對應，每筆資料列來源訊息的 (topic, partition, offset)
+        self.failures = {}  # 分組連續寫入失敗次數
+        self.writing = {}  # schema -> 寫入中的 SchemaWrite，每個 schema 同時只有一個，維持同一個 schema 的寫入順序
+        self.size = 0
+        self.first_row_time = None
+        self.parked = {}  # (schema, 實體表) -> 等待 DDL worker 的資料列 [(schema, table, data, source)]
+        self.parked_versions = {}  # (schema, 實體表) -> 上次檢查這些資料列時的 ddl_versions
+        self.offset_tracker = offset_tracker
+
+    def track(self, source):
+        """登記一筆尚未寫入的資料列，寫入前不會提交其來源訊息的 offset"""
+        if self.offset_tracker and source:
+            self.offset_tracker.add_rows(source)
+
+    def add(self, schema_name, table_name, data, source=None):
+        key = (schema_name, table_name, tuple(sorted(data.keys())))
+        self.groups.setdefault(key, []).append(data)
+        self.sources.setdefault(key, []).append(source)
+
+        if not self.size:
+            self.first_row_time = time.time()
+        self.size += 1
+
+    def park(self, schema_name, table_name, data, source=None, recheck=False):
+        """暫存等待 DDL 的資料列；recheck 為 True 時不等 DDL worker，下一次 release_parked_rows 就重新檢查"""
+        key = (schema_name, column_table(table_name))
+        self.parked.setdefault(key, []).append((schema_name, table_name, data, source))
+        if recheck:
+            self.parked_versions.pop(key, None)
+
+    def is_due(self):
+        """批次已滿或最早的資料已等待超過 linger_seconds"""
+        if not self.size:
+            return False
+        return self.size >= self.batch_size or time.time() - self.first_row_time >= self.linger_seconds
+
+    def done(self, sources):
+        """資料列已寫入或已有其他最終去處 (dead-letter/reject 檔)，其來源 offset 可以提交"""
+        if self.offset_tracker:
+            self.offset_tracker.rows_done([source for source in sources if source])
+
+    def take(self, keys):
+        """把分組移出緩衝區交給寫入，回傳 [(key, rows, sources)]"""
+        batch = []
+        for key in keys:
+            rows = self.groups.pop(key)
+            self.size -= len(rows)
+            batch.append((key, rows, self.sources.pop(key)))
+        if not self.size:
+            self.first_row_time = None
+        return batch
+
+    def restore(self, batch):
+        """寫入失敗的分組放回緩衝區，排在寫入期間新進的同分組資料列前面，留待下次重試"""
+        for key, rows, sources in batch:
+            self.groups[key] = rows + self.groups.get(key, [])
+            self.sources[key] = sources + self.sources.get(key, [])
+            self.size += len(rows)
+        if self.size and self.first_row_time is None:
+            self.first_row_time = time.time()
+
+    def complete(self, batch):
+        """已寫入 (或已送進 spill/dead-letter) 的分組，其來源 offset 可以提交
+
+        這些資料列的鍵此時才記入 recent_keys：還在緩衝中的資料列若因 rebalance 由其他 worker 重播，
+        重播的資料不會被當成重複而丟棄。
+        """
+        for key, rows, sources in batch:
+            if DEDUP_CACHE_SIZE:
+                recent_keys.record(dedup_key(key[0], key[1], row) for row in rows)
+            self.done(sources)
+            self.failures.pop(key, None)
+
+class SchemaWrite:
+    """交給 db_write_executor 的一個 schema 的批次；groups 與 isolated 為 [(key, rows, sources)]"""
+
+    def __init__(self, future, groups, isolated, first_row_time, full):
+        self.future = future
+        self.groups = groups
+        self.isolated = isolated
+        self.first_row_time = first_row_time or time.time()
+        self.full = full
+        self.started = time.time()
+        self.rows = sum(len(rows) for _, rows, _ in groups + isolated)
+
+class RecentKeys:
+    """有上限的最近寫入鍵 (LRU)，Kafka rebalance 後重播的資料在進資料庫前就被丟棄
+
+    只記錄已寫入 (或已有最終去處) 的鍵，尚未寫入的資料列重播時不會被丟棄。
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def seen(self, key):
+        """已寫入過回傳 True"""
+        with self.lock:
+            if key in self.keys:
+                self.keys.move_to_end(key)
+                return True
+            return False
+
+    def record(self, keys):
+        with self.lock:
+            for key in keys:
+                if key is None:
+                    continue
+                self.keys[key] = None
+                self.keys.move_to_end(key)
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+
+def dedup_key(schema_name, table_name, data):
+    """recent_keys 使用的鍵，沒有 serialnumber 的資料列不去重 (回傳 None)"""
+    serial_number = data.get("serialnumber")
+    if serial_number is None:
+        return None
+    return (schema_name, table_name, serial_number, str(data.get("collecttime")))
+
+recent_keys = RecentKeys(DEDUP_CACHE_SIZE)
+alarm_tracker = AlarmTracker()
 
 def topic_divide(topic):
     parts = topic.split("/")  
@@ -51,11 +392,18 @@ def topic_divide(topic):
 
     return customer_id,inverter_brand,inverter_devicetype, datalogger_brand, datalogger_sn 
 
+def get_admin_client():
+    global admin_client
+    with admin_client_lock:
+        if admin_client is None:
+            admin_client = AdminClient({'bootstrap.servers': KAFKA_BROKER})
+        return admin_client
+
 def list_kafka_topics():
     """獲取 Kafka 中所有的 Topics"""
     global kafka_topic_list
-    admin_client = AdminClient({'bootstrap.servers': KAFKA_BROKER})
-    metadata = admin_client.list_topics(timeout=10)
+    metadata = get_admin_client().list_topics(timeout=10)
+    known_topics.update(metadata.topics.keys())
 
     kafka_topic_list = [
         topic for topic in metadata.topics.keys()
@@ -64,83 +412,125 @@ def list_kafka_topics():
 
 def list_postgres_schemas():
     """列出 PostgreSQL 中所有數字名稱的 Schemas"""
-    global postgres_schema_list
-    with engine.begin() as connection:
+    global postgres_schemas
+    with ddl_engine.begin() as connection:
         schema_query = text("""
             SELECT schema_name FROM information_schema.schemata
             WHERE schema_name ~ '^[0-9]+$'  -- 只選擇全數字的 schema
               AND schema_name NOT IN ('pg_catalog', 'information_schema', 'pg_toast')
         """)
-        postgres_schema_list = [row[0] for row in connection.execute(schema_query)]
+        postgres_schemas = {row[0] for row in connection.execute(schema_query)}
 
 def setup_postgres_from_kafka():
     """依據 Kafka Topics 建立 PostgreSQL Schemas 和 Tables"""
-    global postgres_schema_list,kafka_topic_list
+    global postgres_schemas,kafka_topic_list
 
     print(f"{datetime.now()} setup_postgres_from_kafka kafka_topics:",kafka_topic_list)
-    print(f"{datetime.now()} setup_postgres_from_kafka schema_list:",postgres_schema_list)
+    print(f"{datetime.now()} setup_postgres_from_kafka schema_list:",sorted(postgres_schemas))
 
     for topic in kafka_topic_list or not topic.isdigit():
         if topic.startswith("__"):  # 忽略 Kafka 內建 Topic
             continue
 
         # 確保 PostgreSQL Schema 存在
-        if topic not in postgres_schema_list:
+        if topic not in postgres_schemas:
             create_schema(topic)
             create_table(topic, "inverter")
             create_table(topic, "alarm")
 
-            postgres_schema_list.append(topic)
+            postgres_schemas.add(topic)
 
 def check_and_update_schema_tables():
-    """檢查 PostgreSQL schemas 是否包含 'inverter' 和 'alarm' 表，並更新 column_cache"""
-    global column_cache,postgres_schema_list
-
-    with engine.begin() as connection:
-        for schema in postgres_schema_list:
-            # 查詢該 schema 下的 tables
-            table_query = text(f"""
-                SELECT table_name FROM information_schema.tables
-                WHERE table_schema = '{schema}'
-            """)
-            existing_tables = {row[0] for row in connection.execute(table_query)}
-
-            # 確保 `inverter` 和 `alarm` 表都存在
-            required_tables = ["inverter", "alarm"]
-            for table in required_tables:
-                if table not in existing_tables:
-                    create_table(schema, table)  # 如果表不存在，則建立
-
-            # 初始化 schema 層級
-            if schema not in column_cache:
-                column_cache[schema] = {}
-
-            # 查詢現有的欄位並更新 column_cache
-            for table in required_tables:
-                column_query = text(f"""
-                    SELECT column_name FROM information_schema.columns
-                    WHERE table_schema = '{schema}' AND table_name = '{table}'
-                """)
-                existing_columns = {row[0] for row in connection.execute(column_query)}
-                
-                # 更新快取
-                column_cache[schema][table] = existing_columns
+    """檢查 PostgreSQL schemas 是否包含 'inverter' 和 'alarm' 表，並更新 column_cache
 
-    print(f"{datetime.now()} Schema and table validation completed. column_cache updated ")
+    以少數幾個 pg_catalog 查詢一次載入所有數字 schema 的表、欄位、索引與約束，
+    不再對每個 schema × table 個別查詢 information_schema。
+    """
+    global column_cache,postgres_schemas
+    started = time.perf_counter()
+
+    with ddl_engine.begin() as connection:
+        # 所有數字 schema 下 (非 partition) 表的欄位
+        column_rows = connection.execute(text("""
+            SELECT n.nspname, c.relname, a.attname, c.relkind, format_type(a.atttypid, a.atttypmod)
+            FROM pg_catalog.pg_class c
+            JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+            WHERE n.nspname ~ '^[0-9]+$'
+              AND c.relkind IN ('r', 'p')
+              AND NOT c.relispartition
+        """)).fetchall()
+
+        index_rows = connection.execute(text("""
+            SELECT schemaname, indexname FROM pg_catalog.pg_indexes
+            WHERE schemaname ~ '^[0-9]+$'
+        """)).fetchall()
+
+        constraint_rows = connection.execute(text("""
+            SELECT n.nspname, con.conname
+            FROM pg_catalog.pg_constraint con
+            JOIN pg_catalog.pg_namespace n ON n.oid = con.connamespace
+            WHERE n.nspname ~ '^[0-9]+$'
+        """)).fetchall()
+
+    catalog = {}
+    for schema, table, column_name, relkind, _ in column_rows:
+        catalog.setdefault(schema, {}).setdefault(table, set()).add(column_name)
+        if table == "inverter_1d":
+            rollup_tables.add(schema)
+        if relkind == 'p':
+            partitioned_tables.add((schema, table))
+    seed_column_types((column_name, column_type) for _, _, column_name, _, column_type in column_rows)
+
+    index_cache.update((schema, index_name) for schema, index_name in index_rows)
+    constraint_cache.update((schema, constraint_name) for schema, constraint_name in constraint_rows)
+
+    required_tables = ["inverter", "alarm"]
+    index_names = {
+        "inverter": "inverter_timestamp_serialnumber_idx",
+        "alarm": "alarm_timestamp_serialnumber_errormessage_idx",
+    }
+    for schema in sorted(postgres_schemas):
+        existing_tables = catalog.get(schema, {})
+
+        # 確保 `inverter` 和 `alarm` 表都存在
+        for table in required_tables:
+            if table not in existing_tables:
+                create_table(schema, table)  # 如果表不存在，則建立 (同時寫入 column_cache)
+            else:
+                column_cache.setdefault(schema, {})[table] = existing_tables[table]
+
+                # 索引、約束 (inverter 還有彙總表) 都已存在的表，DDL worker 不必再檢查
+                if (schema, index_names[table]) in index_cache and (schema, unique_constraint_name(table)) in constraint_cache \
+                        and (table != "inverter" or not ROLLUPS or schema in rollup_tables):
+                    table_setup_done.add((schema, table))
 
-def check_and_create_topic(topic_name):
-    """如果 Kafka Topic 不存在，則建立新的"""
-    admin_client = AdminClient({'bootstrap.servers': KAFKA_BROKER})
+    elapsed = time.perf_counter() - started
+    print(f"{datetime.now()} Schema and table validation completed in {elapsed:.2f}s "
+          f"({len(postgres_schemas)} schemas, {len(column_rows)} columns). column_cache updated ")
+
+def check_and_create_topic(topic_name, num_partitions=KAFKA_NUM_PARTITIONS):
+    """如果 Kafka Topic 不存在，則建立新的
+
+    partition 數量決定同一 consumer group 內最多可平行消費的 worker 數。
+    已確認存在的 topic 記在 known_topics，不必每次都向 broker 取得完整 metadata。
+    """
+    if topic_name in known_topics:
+        return
+
+    admin_client = get_admin_client()
 
     # 獲取目前所有 Kafka Topics
     existing_topics = admin_client.list_topics(timeout=10).topics.keys()
+    known_topics.update(existing_topics)
 
     if topic_name not in existing_topics:
         print(f"{datetime.now()} 建立新的 Kafka Topic: {topic_name}")
         new_topic = NewTopic(topic_name, 
-                             num_partitions=1, 
+                             num_partitions=num_partitions, 
                              replication_factor=1)
-        admin_client.create_topics([new_topic])
+        admin_client.create_topics([new_topic])[topic_name].result()
+        known_topics.add(topic_name)
     else:
         print(f"{datetime.now()} Kafka Topic {topic_name} 已存在")
 
@@ -148,41 +538,126 @@ def check_and_create_topic(topic_name):
 def create_schema(schema_name):
     """檢查 Schema 是否存在，若不存在則創建"""
 
-    global postgres_schema_list
+    global postgres_schemas
 
-    if schema_name in postgres_schema_list:
+    if schema_name in postgres_schemas:
         return
 
-    with engine.begin() as connection:
+    with ddl_engine.begin() as connection:
 
         connection.execute(text(f'CREATE SCHEMA "{schema_name}"'))
         connection.commit()
-        postgres_schema_list.append(schema_name)
+        postgres_schemas.add(schema_name)
 
         print(f"{datetime.now()} Schema '{schema_name}' created.")
         
 
 def create_table(schema_name, table_name):
-    """創建"""
+    """創建
+
+    PARTITIONED_TABLES 開啟時建立依 collecttime 分區 (RANGE) 的表，並預先建立近期的每日分區。
+    """
     metadata = MetaData()
     
-    columns = [
-        Column("id", Integer, primary_key=True, autoincrement=True),
-        Column("timestamp", DateTime, nullable=False,server_default=func.now())
-    ]
-    
-    new_table = Table(table_name, metadata, *columns, schema=schema_name)
-    metadata.create_all(engine)  
+    if PARTITIONED_TABLES:
+        # 分區表的主鍵與唯一約束都必須包含分區欄位 collecttime
+        columns = [
+            Column("id", Integer, primary_key=True, autoincrement=True),
+            Column("collecttime", DateTime, primary_key=True),
+            Column("timestamp", DateTime, nullable=False,server_default=func.now())
+        ]
+        new_table = Table(table_name, metadata, *columns, schema=schema_name,
+                          postgresql_partition_by="RANGE (collecttime)")
+    else:
+        columns = [
+            Column("id", Integer, primary_key=True, autoincrement=True),
+            Column("timestamp", DateTime, nullable=False,server_default=func.now())
+        ]
+        new_table = Table(table_name, metadata, *columns, schema=schema_name)
+    metadata.create_all(ddl_engine)  
 
     if schema_name not in column_cache:
         column_cache[schema_name] = {}
 
-    column_cache[schema_name][table_name] = {"id", "timestamp"}
+    column_cache[schema_name][table_name] = {column.name for column in columns}
 
     print(f"{datetime.now()} Table '{table_name}' created in schema '{schema_name}'.")
 
+    if PARTITIONED_TABLES:
+        partitioned_tables.add((schema_name, table_name))
+        today = date.today()
+        create_partitions(schema_name, table_name, [today + timedelta(days=i) for i in range(PARTITION_PREMAKE_DAYS + 1)])
+
+def partition_name(table_name, day):
+    return f"{table_name}_{day.strftime('%Y%m%d')}"
+
+def create_partitions(schema_name, table_name, days):
+    """建立指定日期的每日分區 (已存在則略過)，唯一約束與索引會由父表自動套用到每個分區"""
+    missing_days = sorted({day for day in days if (schema_name, table_name, day) not in partition_cache})
+    if not missing_days:
+        return
+
+    with ddl_engine.begin() as connection:
+        for day in missing_days:
+            connection.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS "{schema_name}"."{partition_name(table_name, day)}"
+                PARTITION OF "{schema_name}"."{table_name}"
+                FOR VALUES FROM ('{day}') TO ('{day + timedelta(days=1)}')
+            """))
+
+    partition_cache.update((schema_name, table_name, day) for day in missing_days)
+    print(f"{datetime.now()} Partitions ready for '{schema_name}.{table_name}': {missing_days[0]} ~ {missing_days[-1]}")
+
+def maintain_partitions():
+    """為所有分區表預先建立未來的分區，並依保留天數 detach/drop 過期分區"""
+    today = date.today()
+    upcoming_days = [today + timedelta(days=i) for i in range(PARTITION_PREMAKE_DAYS + 1)]
+
+    for schema_name, table_name in list(partitioned_tables):
+        create_partitions(schema_name, table_name, upcoming_days)
+
+        if not PARTITION_RETENTION_DAYS:
+            continue
+
+        cutoff = partition_name(table_name, today - timedelta(days=PARTITION_RETENTION_DAYS))
+        with ddl_engine.begin() as connection:
+            expired = [row[0] for row in connection.execute(text(f"""
+                SELECT child.relname
+                FROM pg_catalog.pg_inherits i
+                JOIN pg_catalog.pg_class child ON child.oid = i.inhrelid
+                JOIN pg_catalog.pg_class parent ON parent.oid = i.inhparent
+                JOIN pg_catalog.pg_namespace n ON n.oid = parent.relnamespace
+                WHERE n.nspname = '{schema_name}' AND parent.relname = '{table_name}'
+                  AND child.relname ~ '^{table_name}_[0-9]{{8}}$' AND child.relname < '{cutoff}'
+            """))]
+
+            for child in expired:
+                connection.execute(text(f'ALTER TABLE "{schema_name}"."{table_name}" DETACH PARTITION "{schema_name}"."{child}"'))
+                if PARTITION_RETENTION_ACTION == "drop":
+                    connection.execute(text(f'DROP TABLE "{schema_name}"."{child}"'))
+                    print(f"{datetime.now()} Partition '{schema_name}.{child}' dropped (retention {PARTITION_RETENTION_DAYS} days).")
+                else:
+                    print(f"{datetime.now()} Partition '{schema_name}.{child}' detached (retention {PARTITION_RETENTION_DAYS} days).")
+
+        partition_cache.difference_update(
+            key for key in list(partition_cache)
+            if key[:2] == (schema_name, table_name) and partition_name(table_name, key[2]) < cutoff
+        )
+
+def partition_maintenance_worker():
+    while not stop_event.is_set():
+        try:
+            maintain_partitions()
+        except Exception as e:
+            print(f"{datetime.now()} Partition maintenance failed: {e}")
+        stop_event.wait(PARTITION_MAINTENANCE_INTERVAL)
+
 def create_columns(schema_name, table_name, data):
-    """檢查並新增 Kafka 訊息中出現的新欄位"""
+    """檢查並新增 Kafka 訊息中出現的新欄位，回傳新增後的欄位 set
+
+    新欄位由呼叫端在 index/constraint 建立完成後才寫入 column_cache，
+    避免其他 worker 在唯一約束建立前就以 ON CONFLICT 寫入。
+    """
     global column_cache
 
     if schema_name not in column_cache:
@@ -190,7 +665,7 @@ def create_columns(schema_name, table_name, data):
         
     # 使用連接取得當前欄位
     if table_name not in column_cache[schema_name]:
-        with engine.begin() as connection:
+        with ddl_engine.begin() as connection:
             existing_columns = {row[0] for row in connection.execute(text(f"""
                 SELECT column_name FROM information_schema.columns 
                 WHERE table_schema = '{schema_name}' AND table_name = '{table_name}'
@@ -198,35 +673,57 @@ def create_columns(schema_name, table_name, data):
         column_cache[schema_name][table_name] = existing_columns 
     
     existing_columns = column_cache[schema_name][table_name]
-    new_columns = [k for k in data.keys() if k not in existing_columns]
+    new_columns = {k: infer_column_type(k, samples) for k, samples in data.items() if k not in existing_columns}
 
     if not new_columns:
-        return  # 如果沒有新欄位，直接返回
-        
-    with engine.begin() as connection:
-        for key in new_columns:
-            value = data[key]
-            if key == "errormessage" or key == "warningcode":  
-                column_type = "BIGINT"  # **錯誤碼和警告碼使用 BIGINT**
-            elif key.endswith("time"):
-                column_type = "TIMESTAMP WITHOUT TIME ZONE"  # **時間類型**
-            elif key.endswith("voltage") or key.endswith("current") or key.endswith("power") or key.endswith("energy") or key.endswith("frequency"):
-                column_type = "FLOAT"  # **電壓、電流、功率、頻率等**
-            elif isinstance(value, bool):
-                column_type = "BOOLEAN"  # **布林值**
-            elif isinstance(value, int):
-                column_type = "INTEGER"  # **整數**
-            elif isinstance(value, float):
-                column_type = "DOUBLE PRECISION"  # **浮點數**
-            else:
-                column_type = "CHARACTER VARYING(125)"  # **預設為字串**
-
-            alter_sql = f'ALTER TABLE "{schema_name}"."{table_name}" ADD COLUMN "{key}" {column_type}'
-            connection.execute(text(alter_sql))
-            print(f"{datetime.now()} Added new column '{key}' to table '{table_name}' in schema '{schema_name}' with type '{column_type}'.")
-
-        # 更新快取，避免下次重複查詢
-        column_cache[schema_name][table_name].update(new_columns)
+        return existing_columns  # 如果沒有新欄位，直接返回
+
+    # 所有新欄位合併成一個 ALTER TABLE，只需取得一次表鎖
+    alter_sql = f'ALTER TABLE "{schema_name}"."{table_name}" ' + ", ".join(
+        [f'ADD COLUMN IF NOT EXISTS "{key}" {column_type}' for key, column_type in new_columns.items()]
+    )
+    with ddl_engine.begin() as connection:
+        connection.execute(text(alter_sql))
+
+    for key, column_type in new_columns.items():
+        print(f"{datetime.now()} Added new column '{key}' to table '{table_name}' in schema '{schema_name}' with type '{column_type}'.")
+
+    return existing_columns | set(new_columns)
+
+def infer_column_type(key, samples):
+    """決定 PostgreSQL 欄位型別：已知欄位查 modbus_mapping 的型別表，其次沿用其他 schema 已決定的型別，
+    最後才依樣本值推斷並記錄到 column_type_cache"""
+    column_type = registered_column_type(key)
+    if column_type is not None:
+        return column_type
+
+    if not samples:
+        return TEXT_TYPE  # 只出現過 None，不記錄，之後有樣本值的 schema 再決定
+
+    column_type = column_type_cache.setdefault(key, infer_type_from_samples(samples))
+    return column_type
+
+def infer_type_from_samples(samples):
+    """依多個樣本值推斷型別，取能容納所有樣本的型別"""
+    if all(isinstance(value, bool) for value in samples):
+        return "BOOLEAN"  # **布林值**
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in samples):
+        return TEXT_TYPE  # **預設為字串**
+    if any(isinstance(value, float) for value in samples) or not any(samples):
+        return "DOUBLE PRECISION"  # **浮點數；全為 0 時無法判斷是否為整數，以浮點數保存**
+    return "INTEGER"  # **整數**
+
+def seed_column_types(column_types):
+    """以資料庫中既有欄位的型別預先填入 column_type_cache，新客戶的欄位型別與舊客戶一致"""
+    counts = {}
+    for column_name, column_type in column_types:
+        if column_type_for(column_name) is None:
+            key = (column_name, column_type.upper())
+            counts[key] = counts.get(key, 0) + 1
+
+    # 同一欄位在不同 schema 型別不同時取最多 schema 使用的型別
+    for (column_name, column_type), _ in sorted(counts.items(), key=lambda item: -item[1]):
+        column_type_cache.setdefault(column_name, column_type)
 
 
 def create_index(schema_name, table_name):
@@ -235,7 +732,10 @@ def create_index(schema_name, table_name):
     """
     if table_name == "inverter":
         index_name = f"{table_name}_timestamp_serialnumber_idx"
-        with engine.begin() as connection:
+        if (schema_name, index_name) in index_cache:
+            return  # 啟動時已從 pg_catalog 載入，不必再查詢
+
+        with ddl_engine.begin() as connection:
             # 檢查索引是否存在
             check_index_query = text(f"""
                 SELECT 1 FROM pg_indexes 
@@ -252,9 +752,13 @@ def create_index(schema_name, table_name):
                 """)
                 connection.execute(create_index_query)
                 print(f"{datetime.now()} Created index '{index_name}' on '{table_name}' (timestamp,serialnumber).")
+        index_cache.add((schema_name, index_name))
     else:
         index_name = f"{table_name}_timestamp_serialnumber_errormessage_idx"
-        with engine.begin() as connection:
+        if (schema_name, index_name) in index_cache:
+            return
+
+        with ddl_engine.begin() as connection:
             # 檢查索引是否存在
             check_index_query = text(f"""
                 SELECT 1 FROM pg_indexes 
@@ -271,92 +775,680 @@ def create_index(schema_name, table_name):
                 """)
                 connection.execute(create_index_query)
                 print(f"{datetime.now()} Created index '{index_name}' on '{table_name}' (timestamp,serialnumber,errormessage).")
+        index_cache.add((schema_name, index_name))
+
+def unique_constraint_name(table_name):
+    return f"{table_name}_serialnumber_collecttime_unique"
 
 def create_constraints(schema_name, table_name):
-    """為指定資料表新增唯一約束 (UNIQUE) 在 collecttime 欄位"""
-    with engine.begin()as connection:
-        try:
-            # 唯一約束：確保 `collecttime` 不重複
-            constraint_name = f"{table_name}_collecttime_unique"
-
-            # 檢查約束是否已經存在，避免重複建立
-            check_constraint_query = text(f"""
-                SELECT conname 
-                FROM pg_constraint 
-                WHERE conrelid = '{schema_name}.{table_name}'::regclass 
-                AND conname = '{constraint_name}'
-            """)
-            result = connection.execute(check_constraint_query).fetchone()
+    """為指定資料表新增唯一約束 (UNIQUE) 在 (serialnumber, collecttime) 欄位
 
-            if not result:
+    已有資料的表先以 CREATE UNIQUE INDEX CONCURRENTLY 建立索引 (不擋寫入)，再以 ADD CONSTRAINT ... USING INDEX
+    掛上約束，只需短暫持有表鎖；舊的 UNIQUE (collecttime) 約束在同一個 ALTER TABLE 內刪除。
+    失敗時拋出例外，表不會被標記為可寫入，由 DDL worker 稍後重試。
+    """
+    # 唯一約束：確保同一台設備的 `collecttime` 不重複
+    constraint_name = unique_constraint_name(table_name)
+    if (schema_name, constraint_name) in constraint_cache:
+        return  # 啟動時已從 pg_catalog 載入，不必再查詢
+
+    old_constraint = f"{table_name}_collecttime_unique"
+    # CONCURRENTLY 不能在交易內執行，每個語句各自提交
+    with ddl_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        exists = connection.execute(text("""
+            SELECT 1 FROM pg_catalog.pg_constraint
+            WHERE conrelid = CAST(:table AS regclass) AND conname = :constraint
+        """), {"table": f'"{schema_name}"."{table_name}"', "constraint": constraint_name}).fetchone()
+
+        if exists:
+            print(f"{datetime.now()} Unique constraint already exists on '{schema_name}.{table_name}'.")
+        elif (schema_name, table_name) in partitioned_tables or connection.execute(
+                text(f'SELECT NOT EXISTS (SELECT 1 FROM "{schema_name}"."{table_name}")')).scalar():
+            # 分區表不支援 CONCURRENTLY；空表 (剛建立、尚未開放寫入) 直接加約束，不必等 CONCURRENTLY 掃描與等待其他交易
+            connection.execute(text(f"""
+                ALTER TABLE "{schema_name}"."{table_name}"
+                DROP CONSTRAINT IF EXISTS "{old_constraint}",
+                ADD CONSTRAINT "{constraint_name}" UNIQUE ("serialnumber", "collecttime")
+            """))
+            print(f"{datetime.now()} Unique constraint added to '{schema_name}.{table_name}' on (serialnumber, collecttime).")
+        else:
+            index_valid = connection.execute(text("""
+                SELECT i.indisvalid FROM pg_catalog.pg_index i
+                JOIN pg_catalog.pg_class c ON c.oid = i.indexrelid
+                JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = :schema AND c.relname = :index
+            """), {"schema": schema_name, "index": constraint_name}).scalar()
+            if index_valid is False:
+                # 上次 CONCURRENTLY 中斷留下的無效索引
+                connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{schema_name}"."{constraint_name}"'))
+            if not index_valid:
                 connection.execute(text(f"""
-                    ALTER TABLE "{schema_name}"."{table_name}" 
-                    ADD CONSTRAINT "{constraint_name}" UNIQUE ("collecttime")
+                    CREATE UNIQUE INDEX CONCURRENTLY "{constraint_name}"
+                    ON "{schema_name}"."{table_name}" ("serialnumber", "collecttime")
                 """))
-                
-                print(f"{datetime.now()} Unique constraint added to '{schema_name}.{table_name}' on collecttime.")
-            else:
-                print(f"{datetime.now()} Unique constraint already exists on '{schema_name}.{table_name}'.")
+            connection.execute(text(f"""
+                ALTER TABLE "{schema_name}"."{table_name}"
+                DROP CONSTRAINT IF EXISTS "{old_constraint}",
+                ADD CONSTRAINT "{constraint_name}" UNIQUE USING INDEX "{constraint_name}"
+            """))
+            print(f"{datetime.now()} Unique constraint added to '{schema_name}.{table_name}' on (serialnumber, collecttime) "
+                  f"using a concurrently built index.")
+
+    constraint_cache.discard((schema_name, old_constraint))
+    constraint_cache.add((schema_name, constraint_name))
+
+def migrate_dedup_constraints():
+    """把既有表的 UNIQUE (collecttime) 換成 UNIQUE (serialnumber, collecttime)
+
+    舊約束讓同一秒回報的兩台逆變器互相衝突而遺失資料。需先執行 check_and_update_schema_tables 載入快取；
+    需要遷移的表交給 DDL worker 在背景由 create_constraints 以 CONCURRENTLY 建立新索引後再換掉約束，
+    不擋住 consumer 啟動。這些表在換好之前不會被標記為可寫入，資料列先暫存，失敗的表由 DDL worker 重試。
+    """
+    start_ddl_workers()
+    queued = 0
+    for schema_name, tables in list(column_cache.items()):
+        for table_name, columns in list(tables.items()):
+            old_constraint = f"{table_name}_collecttime_unique"
+            new_constraint = unique_constraint_name(table_name)
+
+            if (schema_name, old_constraint) not in constraint_cache or (schema_name, new_constraint) in constraint_cache:
+                continue
+            if not set(DEDUP_COLUMNS) <= columns:
+                continue
+
+            with pending_columns_lock:
+                if (schema_name, table_name) in pending_columns:
+                    continue  # 已在 DDL worker 佇列中
+                pending_columns[(schema_name, table_name)] = {}
+            ddl_queues[hash(schema_name) % len(ddl_queues)].put((schema_name, table_name))
+            queued += 1
+
+    print(f"{datetime.now()} Dedup constraint migration queued for {queued} tables.")
+
+def create_unresolved_alarm_index(schema_name, concurrently=False):
+    """只包含未解除告警的部分索引，啟動重建狀態時不必掃描整個告警歷史
+
+    新建的空表直接建立；已有資料的表以 concurrently=True 用 CREATE INDEX CONCURRENTLY 建立，不擋寫入。
+    """
+    index_name = "alarm_unresolved_idx"
+    if (schema_name, index_name) in index_cache:
+        return
+
+    if not concurrently:
+        with ddl_engine.begin() as connection:
+            connection.execute(text(f"""
+                CREATE INDEX IF NOT EXISTS "{index_name}" ON "{schema_name}"."alarm" ("collecttime")
+                WHERE alertstatus = 'unresolved'
+            """))
+        index_cache.add((schema_name, index_name))
+        return
+
+    # CONCURRENTLY 不能在交易內執行，每個語句各自提交
+    with ddl_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        index_valid = connection.execute(text("""
+            SELECT i.indisvalid FROM pg_catalog.pg_index i
+            JOIN pg_catalog.pg_class c ON c.oid = i.indexrelid
+            JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schema AND c.relname = :index
+        """), {"schema": schema_name, "index": index_name}).scalar()
+        if index_valid is False:
+            # 上次 CONCURRENTLY 中斷留下的無效索引
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{schema_name}"."{index_name}"'))
+        if not index_valid:
+            connection.execute(text(f"""
+                CREATE INDEX CONCURRENTLY "{index_name}" ON "{schema_name}"."alarm" ("collecttime")
+                WHERE alertstatus = 'unresolved'
+            """))
+    index_cache.add((schema_name, index_name))
+
+def build_unresolved_alarm_indexes(schemas):
+    """背景為既有的告警表建立未解除告警索引，下次啟動重建狀態時才用得到，不必擋住這次啟動"""
+    built = 0
+    for schema_name in schemas:
+        try:
+            create_unresolved_alarm_index(schema_name, concurrently=True)
+            built += 1
         except Exception as e:
-            print(f"{datetime.now()} Error adding unique constraint to '{schema_name}.{table_name}': {e}")
+            print(f"{datetime.now()} Error creating unresolved alarm index on '{schema_name}.alarm': {e}")
+    print(f"{datetime.now()} Unresolved alarm indexes built for {built} of {len(schemas)} schemas.")
 
+def rebuild_alarm_state():
+    """以一個 UNION ALL 查詢載入所有 schema 最近 ALARM_REBUILD_DAYS 天內未解除的告警，重建 alarm_tracker
 
-def consumer_worker():
-    """Kafka 消費者持續監聽 Kafka topic 並將數據寫入資料庫"""
-    global kafka_topic_list
-    old_kafka_topic_list=[]
-    consumer_config = {
-        'bootstrap.servers': KAFKA_BROKER,
-        'group.id': 'iot_consumer_group',
-        'auto.offset.reset': 'earliest',
-        'enable.auto.commit': True,  # 自動提交 offset
-        'auto.commit.interval.ms': 5000  # 每 5 秒自動提交
-    }
-    consumer = Consumer(consumer_config)
+    需先執行 check_and_update_schema_tables 載入 column_cache。
+    """
+    required_columns = {"serialnumber", "collecttime", "errormessage", "alertstatus"}
+    schemas = sorted(schema_name for schema_name, tables in column_cache.items()
+                     if required_columns <= tables.get("alarm", set()))
+    if not schemas:
+        return
 
-    while not kafka_topic_list:
-        print(f"{datetime.now()}  No available Kafka topics at startup. Retrying in 60 seconds...")
-        list_kafka_topics()  # 重新獲取 Kafka topic 列表
-        time.sleep(60)
+    # 分區表不支援 CONCURRENTLY，沿用 collecttime 分區裁剪即可
+    missing_index = [schema_name for schema_name in schemas
+                     if (schema_name, "alarm_unresolved_idx") not in index_cache
+                     and (schema_name, "alarm") not in partitioned_tables]
+    if missing_index:
+        threading.Thread(target=build_unresolved_alarm_indexes, args=(missing_index,),
+                         name="alarm-index", daemon=True).start()
+
+    query = " UNION ALL ".join(f"""
+        SELECT '{schema_name}' AS schema_name, serialnumber, collecttime, errormessage
+        FROM "{schema_name}"."alarm"
+        WHERE alertstatus = 'unresolved' AND collecttime >= :since
+    """ for schema_name in schemas) + " ORDER BY collecttime"
+
+    with ddl_engine.begin() as connection:
+        rows = connection.execute(text(query), {"since": datetime.now() - timedelta(days=ALARM_REBUILD_DAYS)}).fetchall()
+
+    for schema_name, serial_number, collect_time, error_code in rows:
+        alarm_tracker.restore(schema_name, serial_number, collect_time, error_code)
+
+    print(f"{datetime.now()} Alarm state rebuilt: {alarm_tracker.active_count()} active alarms "
+          f"from {len(rows)} unresolved rows in {len(schemas)} schemas.")
+
+
+@lru_cache(maxsize=4096)
+def valid_column_name(key):
+    """可以作為欄位名稱：非空、不含雙引號與 NUL，且不超過 PostgreSQL 識別字上限 63 bytes (超過會被截斷而對不上)"""
+    return bool(key) and '"' not in key and "\x00" not in key and len(key.encode("utf-8")) <= 63
+
+def failed_column(schema_name, table_name, key):
+    """回傳欄位放棄新增時的錯誤訊息，未放棄或已超過 DDL_FAILURE_TTL 時回傳 None"""
+    failed = failed_columns.get((schema_name, table_name), {}).get(key)
+    if failed is None or time.time() - failed[1] >= DDL_FAILURE_TTL:
+        return None
+    return failed[0]
+
+def rejected_columns(schema_name, table_name, data):
+    """資料列中無法成為欄位的鍵：{欄位: 原因}"""
+    rejected = {}
+    for key in data:
+        if not valid_column_name(key):
+            rejected[key] = "invalid column name"
+        else:
+            error = failed_column(schema_name, table_name, key)
+            if error is not None:
+                rejected[key] = error
+    return rejected
+
+def failed_partition(schema_name, table_name, day):
+    """回傳分區放棄建立時的錯誤訊息，未放棄或已超過 DDL_FAILURE_TTL 時回傳 None"""
+    failed = failed_partitions.get((schema_name, table_name), {}).get(day)
+    if failed is None or time.time() - failed[1] >= DDL_FAILURE_TTL:
+        return None
+    return failed[0]
+
+@lru_cache(maxsize=65536)
+def parse_collect_time(value):
+    """collecttime 轉成 datetime，無法解析時回傳 None"""
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+def invalid_row_reason(data):
+    """資料列缺少 serialnumber 或 collecttime 無法解析時回傳原因：無法去重，分區表也無法決定寫入哪個分區"""
+    if data.get("serialnumber") in (None, ""):
+        return "missing serialnumber"
+    collect_time = data.get("collecttime")
+    if collect_time is None or parse_collect_time(str(collect_time)) is None:
+        return f"invalid collecttime: {collect_time!r}"
+    return None
+
+def rejection_reason(schema_name, table_name, data):
+    """暫存的資料列不可能再寫入時回傳原因 (資料列無效、欄位或分區已放棄建立)，仍可等待時回傳 None"""
+    reason = invalid_row_reason(data)
+    if reason is not None:
+        return reason
+    rejected = rejected_columns(schema_name, table_name, data)
+    if rejected:
+        return f"cannot add columns: {rejected}"
+    if (schema_name, table_name) in partitioned_tables:
+        error = failed_partition(schema_name, table_name, parse_collect_time(str(data["collecttime"])).date())
+        if error is not None:
+            return f"cannot create partition: {error}"
+    return None
+
+def request_partition(schema_name, table_name, day):
+    """登記缺少的分區並通知 DDL worker，呼叫端不等待分區建立；已放棄建立的分區不登記"""
+    if failed_partition(schema_name, table_name, day):
+        return
+    start_ddl_workers()
+
+    with pending_columns_lock:
+        days = pending_partitions.setdefault((schema_name, table_name), set())
+        if day in days:
+            return
+        days.add(day)
+        if (schema_name, table_name) not in pending_columns:
+            pending_columns[(schema_name, table_name)] = {}
+            ddl_queues[hash(schema_name) % len(ddl_queues)].put((schema_name, table_name))
+
+def partition_ready(schema_name, table_name, data):
+    """分區表中資料列所屬日期的分區已建立時回傳 True；否則交給 DDL worker 建立並回傳 False"""
+    day = parse_collect_time(str(data["collecttime"])).date()
+    if (schema_name, table_name, day) in partition_cache:
+        return True
+    request_partition(schema_name, table_name, day)
+    return False
+
+def request_columns(schema_name, table_name, data):
+    """登記缺少的欄位並通知 DDL worker，呼叫端不等待 DDL 完成；無效或已放棄的欄位不登記"""
+    start_ddl_workers()
+    existing_columns = column_cache.get(schema_name, {}).get(table_name, set())
+
+    with pending_columns_lock:
+        already_queued = (schema_name, table_name) in pending_columns
+        pending = pending_columns.setdefault((schema_name, table_name), {})
+        for key, value in data.items():
+            if key in existing_columns or not valid_column_name(key) or failed_column(schema_name, table_name, key):
+                continue
+            samples = pending.setdefault(key, [])
+            if value is not None and len(samples) < TYPE_SAMPLE_SIZE:
+                samples.append(value)  # 收集多個非 None 樣本值供判斷型別
 
-    consumer.subscribe(kafka_topic_list)
-    old_kafka_topic_list = kafka_topic_list
+        if already_queued:
+            return
+        if pending or (schema_name, table_name) not in table_setup_done:
+            ddl_queues[hash(schema_name) % len(ddl_queues)].put((schema_name, table_name))  # 新欄位或尚未建立唯一約束
+        else:
+            pending_columns.pop((schema_name, table_name))
 
-    last_refresh_time = time.time() 
+def columns_ready(schema_name, table_name, data):
+    """表已建立唯一約束、欄位都已存在 (分區表還需要資料列所屬日期的分區) 時回傳 True；否則交給 DDL worker 處理並回傳 False
 
+    唯一約束建立前不寫入，否則 ON CONFLICT (serialnumber, collecttime) 會失敗；分區不在寫入路徑上建立。
+    """
+    existing_columns = column_cache.get(schema_name, {}).get(table_name)
+    if existing_columns is not None and (schema_name, table_name) in table_setup_done and not data.keys() - existing_columns:
+        column_cache_stats["hits"] += 1
+        return (schema_name, table_name) not in partitioned_tables or partition_ready(schema_name, table_name, data)
+
+    column_cache_stats["misses"] += 1
+    request_columns(schema_name, table_name, data)
+    return False
+
+def provision_schema(schema_name):
+    """新 topic 被分配到時先在背景建立 schema 與 inverter/alarm 表，不等第一筆資料"""
+    start_ddl_workers()
+    ddl_queues[hash(schema_name) % len(ddl_queues)].put((schema_name, "inverter"))
+
+def apply_pending_columns(schema_name, table_name, columns):
+    """建立缺少的 schema/table，再以一個 ALTER TABLE 新增欄位"""
+    if schema_name not in postgres_schemas:
+        create_schema(schema_name)
+        create_table(schema_name, "inverter")
+        create_table(schema_name, "alarm")
+
+    table_columns = create_columns(schema_name, table_name, columns)
+
+    # index/constraint 只需在欄位齊全後建立一次，不必每次新增欄位都檢查
+    if (schema_name, table_name) not in table_setup_done:
+        required_columns = {"timestamp", "serialnumber", "collecttime"}
+        if table_name == "alarm":
+            required_columns.add("errormessage")
+
+        if required_columns <= table_columns:
+            create_index(schema_name, table_name)
+            create_constraints(schema_name, table_name)
+            if table_name == "alarm" and "alertstatus" in table_columns:
+                create_unresolved_alarm_index(schema_name)
+            if table_name == "inverter" and ROLLUPS:
+                ensure_rollup_tables(schema_name)  # 寫入時會同時更新彙總表，寫入端不執行 DDL
+            table_setup_done.add((schema_name, table_name))
+
+    # 更新快取，避免下次重複查詢 (以新 set 取代，其他 worker 讀取時不會遇到修改中的 set)
+    column_cache[schema_name][table_name] = table_columns
+
+def ddl_worker(ddl_queue):
+    """背景執行 DDL：同一張表累積的新欄位一次加入，完成後才更新 column_cache
+
+    分區表缺少的每日分區 (pending_partitions) 也在這裡建立。
+    失敗的表記下重試時間 (DDL_RETRY_SECONDS 起每次加倍)，等待期間照常處理佇列中其他表；
+    連續失敗 DDL_MAX_RETRIES 次後交給 give_up_columns。欄位本身沒問題 (失敗的是 schema/唯一約束) 時
+    資料列不能寫入也不能丟棄，之後以最長的間隔持續重試。
+    """
+    delayed = []  # (重試時間, schema, table)
     while True:
+        timeout = max(delayed[0][0] - time.time(), 0) if delayed else None
         try:
-            if time.time() - last_refresh_time >= 3600:
-                print(f"{datetime.now()} Refreshing Kafka topic subscriptions...")
-                if len(kafka_topic_list)-len(old_kafka_topic_list) > 0:
-                    consumer.subscribe(kafka_topic_list)  # 重新訂閱
-                    old_kafka_topic_list = kafka_topic_list
-                last_refresh_time = time.time()  # 更新上次訂閱時間
-
-            messages = consumer.poll(timeout=10)
-            
-            if not messages:
+            schema_name, table_name = ddl_queue.get(timeout=timeout)
+        except queue.Empty:
+            _, schema_name, table_name = heapq.heappop(delayed)
+
+        with pending_columns_lock:
+            columns = {key: list(samples) for key, samples in pending_columns.get((schema_name, table_name), {}).items()}
+            days = set(pending_partitions.get((schema_name, table_name), ()))
+
+        try:
+            with metrics.timer("ddl_seconds"):
+                apply_pending_columns(schema_name, table_name, columns)
+                if days:
+                    create_partitions(schema_name, table_name, days)
+            ddl_failures.pop((schema_name, table_name), None)
+        except Exception as e:
+            failures = ddl_failures.get((schema_name, table_name), 0) + 1
+            ddl_failures[(schema_name, table_name)] = failures
+            if failures != DDL_MAX_RETRIES or not give_up_columns(schema_name, table_name, columns, e, days):
+                delay = DDL_RETRY_SECONDS * 2 ** (min(failures, DDL_MAX_RETRIES) - 1)
+                print(f"{datetime.now()} Failed to add columns to '{schema_name}.{table_name}': {e}. Retrying in {delay:g} seconds...")
+                heapq.heappush(delayed, (time.time() + delay, schema_name, table_name))
                 continue
+            ddl_failures.pop((schema_name, table_name), None)
+
+        with pending_columns_lock:
+            pending = pending_columns.get((schema_name, table_name), {})
+            for key in columns:
+                pending.pop(key, None)
+            remaining_days = pending_partitions.pop((schema_name, table_name), set()) - days
+            if remaining_days:
+                pending_partitions[(schema_name, table_name)] = remaining_days
+            if pending or remaining_days:
+                ddl_queue.put((schema_name, table_name))  # 執行期間又出現的新欄位或分區
+            else:
+                pending_columns.pop((schema_name, table_name), None)
+            ddl_versions[(schema_name, table_name)] = ddl_versions.get((schema_name, table_name), 0) + 1
+
+def give_up_columns(schema_name, table_name, columns, error, days=()):
+    """DDL 多次失敗後逐欄、逐日再試一次 (一個有問題的欄位或分區不拖累其他的)
+
+    仍失敗的欄位記入 failed_columns、分區記入 failed_partitions 並回傳 {欄位或日期: 例外}；
+    等待這些欄位或分區的資料列由 release_parked_rows 送往 dead-letter/reject 檔，不再擋住 offset。
+    """
+    failed = {}
+    for key, samples in columns.items():
+        try:
+            create_columns(schema_name, table_name, {key: samples})  # 不含 index/constraint，失敗的才是欄位本身的問題
+        except Exception as e:
+            failed[key] = e
+    failed_days = {}
+    for day in sorted(days):
+        try:
+            create_partitions(schema_name, table_name, [day])
+        except Exception as e:
+            failed_days[day] = e
+
+    failed_at = time.time()
+    with pending_columns_lock:
+        entry = failed_columns.setdefault((schema_name, table_name), {})
+        for key, e in failed.items():
+            entry[key] = (str(e)[:1000], failed_at)
+        entry = failed_partitions.setdefault((schema_name, table_name), {})
+        for day, e in failed_days.items():
+            entry[day] = (str(e)[:1000], failed_at)
+    if failed:
+        metrics.increment("ddl_columns_failed_total", len(failed), schema=schema_name)
+        print(f"{datetime.now()} Gave up adding columns {sorted(failed)} to '{schema_name}.{table_name}' "
+              f"after {DDL_MAX_RETRIES} attempts: {error}")
+    if failed_days:
+        metrics.increment("ddl_partitions_failed_total", len(failed_days), schema=schema_name)
+        print(f"{datetime.now()} Gave up creating partitions {[str(day) for day in sorted(failed_days)]} "
+              f"for '{schema_name}.{table_name}' after {DDL_MAX_RETRIES} attempts: {error}")
+    if not failed and not failed_days:
+        print(f"{datetime.now()} Setup of '{schema_name}.{table_name}' failed {DDL_MAX_RETRIES} times, rows keep waiting.")
+    return {**failed, **failed_days}
+
+def start_ddl_workers():
+    with pending_columns_lock:
+        if ddl_threads:
+            return
+
+        for index, ddl_queue in enumerate(ddl_queues):
+            ddl_thread = threading.Thread(target=ddl_worker, args=(ddl_queue,), name=f"ddl-worker-{index}", daemon=True)
+            ddl_thread.start()
+            ddl_threads.append(ddl_thread)
+
+def column_table(table_name):
+    """分組對應的實體表，決定要檢查哪張表的欄位"""
+    return "alarm" if table_name == ALARM_RESOLUTION else table_name
+
+def release_parked_rows(row_buffer):
+    """把欄位已由 DDL worker 建立完成的暫存資料列移入批次
+
+    無效的資料列，以及含無效欄位名稱、已放棄新增的欄位或分區的資料列送往 dead-letter/reject 檔，不再等待。
+    暫存的資料列依 (schema, 實體表) 分組，只有 DDL worker 處理完該表 (或放棄) 後才重新檢查，
+    等待期間不必每一輪都逐筆查詢 column_cache。
+    告警解除在對應的告警資料列移入批次後才移入，否則 UPDATE 找不到要解除的告警。
+    """
+    if not row_buffer.parked:
+        return
 
-            if messages is None or messages.error():
-                print(f"{datetime.now()} Kafka consumer error: {messages.error()}")
+    rejected = {}
+    for key in list(row_buffer.parked):
+        version = ddl_versions.get(key, 0)
+        if row_buffer.parked_versions.get(key) == version:
+            continue  # DDL worker 尚未處理這張表，檢查結果不會改變
+        row_buffer.parked_versions[key] = version
+
+        parked = row_buffer.parked.pop(key)
+        resolutions = [entry for entry in parked if entry[1] == ALARM_RESOLUTION]
+        parked = [entry for entry in parked if entry[1] != ALARM_RESOLUTION]
+        for schema_name, table_name, data, source in parked + resolutions:
+            if table_name == ALARM_RESOLUTION and alarm_parked(row_buffer, schema_name, data["serialnumber"], data["collecttime"]):
+                row_buffer.park(schema_name, table_name, data, source)
+                continue
+            if invalid_row_reason(data) is None and columns_ready(schema_name, column_table(table_name), data):
+                row_buffer.add(schema_name, table_name, data, source)
                 continue
 
-            data = json.loads(messages.value().decode('utf-8'))
+            reason = rejection_reason(schema_name, column_table(table_name), data)
+            if reason is not None:
+                rejected.setdefault((schema_name, table_name, reason), []).append((data, source))
+            else:
+                row_buffer.park(schema_name, table_name, data, source)
+
+        if key not in row_buffer.parked:
+            row_buffer.parked_versions.pop(key, None)
+
+    for (schema_name, table_name, error), entries in rejected.items():
+        try:
+            reject_rows(schema_name, table_name, [data for data, _ in entries], error)
+        except Exception as e:
+            print(f"{datetime.now()} Failed to reject rows for '{schema_name}.{table_name}': {e}")
+            for data, source in entries:
+                row_buffer.park(schema_name, table_name, data, source, recheck=True)  # 下一輪再試
+            continue
+        row_buffer.done([source for _, source in entries])
+
+def get_dead_letter_producer():
+    global dead_letter_producer
+    with dead_letter_lock:
+        if dead_letter_producer is None:
+            dead_letter_producer = Producer({'bootstrap.servers': KAFKA_BROKER})
+        return dead_letter_producer
+
+def send_to_dead_letter(records):
+    """把無法處理的資料送進 DEAD_LETTER_TOPIC，等 broker 確認收到後才回傳
+
+    records 為 (key, value, headers)，送出失敗時拋出例外，呼叫端保留資料下次重試。
+    """
+    producer = get_dead_letter_producer()
+    delivery_errors = []
+
+    def on_delivery(err, msg):
+        if err:
+            delivery_errors.append(err)
+
+    for key, value, headers in records:
+        producer.produce(DEAD_LETTER_TOPIC, key=key, value=value, headers=headers, on_delivery=on_delivery)
+    producer.flush()
+
+    if delivery_errors:
+        raise KafkaException(delivery_errors[0])
+    metrics.increment("dead_letter_total", len(records))
+
+def dead_letter_rows(schema_name, table_name, rows, error):
+    send_to_dead_letter([
+        (None, json.dumps({"schema": schema_name, "table": table_name, "data": row}, default=str).encode("utf-8"),
+         {"error": str(error)[:1000]})
+        for row in rows
+    ])
+    print(f"{datetime.now()} Sent {len(rows)} rows for '{schema_name}.{table_name}' to dead-letter topic {DEAD_LETTER_TOPIC}: {error}")
+
+def write_reject_file(schema_name, table_name, rows, error):
+    """附加到 REJECT_FILE 並 fsync，寫入完成後這些資料列的 offset 才可以提交"""
+    lines = "".join(
+        json.dumps({"time": datetime.now(), "schema": schema_name, "table": table_name, "data": row,
+                    "error": str(error)[:1000]}, default=str) + "\n"
+        for row in rows
+    )
+    with reject_file_lock, open(REJECT_FILE, "a", encoding="utf-8") as reject_file:
+        reject_file.write(lines)
+        reject_file.flush()
+        os.fsync(reject_file.fileno())
+    print(f"{datetime.now()} Wrote {len(rows)} rows for '{schema_name}.{table_name}' to {REJECT_FILE}: {error}")
+
+def raw_field(value):
+    """訊息的 key/value 以文字寫入 REJECT_FILE，不是 UTF-8 時改存 base64"""
+    if value is None:
+        return None, None
+    try:
+        return value.decode("utf-8"), None
+    except UnicodeDecodeError:
+        return base64.b64encode(value).decode("ascii"), "base64"
+
+def write_reject_message(message, error):
+    """無法解析的訊息原樣附加到 REJECT_FILE 並 fsync"""
+    key, key_encoding = raw_field(message.key())
+    value, value_encoding = raw_field(message.value())
+    record = {"time": datetime.now(), "topic": message.topic(), "partition": message.partition(),
+              "offset": message.offset(), "key": key, "value": value, "error": str(error)[:1000]}
+    if key_encoding:
+        record["key_encoding"] = key_encoding
+    if value_encoding:
+        record["value_encoding"] = value_encoding
+    with reject_file_lock, open(REJECT_FILE, "a", encoding="utf-8") as reject_file:
+        reject_file.write(json.dumps(record, default=str) + "\n")
+        reject_file.flush()
+        os.fsync(reject_file.fileno())
+    print(f"{datetime.now()} Wrote message {message.topic()}[{message.partition()}]@{message.offset()} to {REJECT_FILE}: {error}")
+
+def reject_rows(schema_name, table_name, rows, error):
+    """無法寫入的資料列送進 dead-letter topic；未設定或送出失敗時寫入 REJECT_FILE，資料一定有最終去處"""
+    if DEAD_LETTER_TOPIC:
+        try:
+            dead_letter_rows(schema_name, table_name, rows, error)
+            metrics.increment("rows_rejected_total", len(rows), schema=schema_name, table=table_name)
+            return
+        except Exception as e:
+            print(f"{datetime.now()} Failed to send rows to dead-letter topic: {e}")
+
+    write_reject_file(schema_name, table_name, rows, error)
+    metrics.increment("rows_rejected_total", len(rows), schema=schema_name, table=table_name)
+
+def commit_processed(consumer, offset_tracker, asynchronous=True):
+    """提交每個 partition 已完整寫入的最高連續 offset
 
-            kafka_topic = messages.topic()
+    平時以非同步提交，不佔用消費迴圈的時間；失敗時由 on_commit 清除紀錄，下一輪再提交一次。
+    """
+    offsets = offset_tracker.committable()
+    if not offsets:
+        return
 
-            inverter_brand = data.pop("inverter_brand", None)  # Remove "inverter_brand" from data
-            inverter_devicetype = data.pop("devicetype", None)  # Remove "inverter_devicetype"
+    consumer.commit(offsets=offsets, asynchronous=asynchronous)
+    offset_tracker.mark_committed(offsets)
 
-            # write_to_influx_db(kafka_topic, inverter_brand, inverter_devicetype, data)
-            write_to_postgresql_db(kafka_topic, inverter_brand, inverter_devicetype, data)
-            error_message = random.choice(list(GoodWe(devicetype="GW50KN-MT").ERROR_MESSAGE_MAP.keys())) #建立錯誤假資料
-            data["errormessage"] = error_message
-            if data["errormessage"] != 0:
+def consumer_worker():
+    """Kafka 消費者持續監聽 Kafka topic 並將數據批次寫入資料庫
+
+    以 regex 訂閱 KAFKA_TOPIC_PATTERN，新客戶的 topic 會在下一次 metadata 更新
+    (TOPIC_METADATA_REFRESH_MS) 時自動加入並觸發 rebalance，不必重新訂閱。
+    """
+    offset_tracker = OffsetTracker()
 
-                write_to_postgresql_db(kafka_topic, inverter_brand, inverter_devicetype, data)
+    def on_commit(err, partitions):
+        if err:
+            print(f"{datetime.now()} Offset commit failed: {err}")
+            offset_tracker.forget_committed(partitions)
 
+    consumer_config = {
+        'bootstrap.servers': KAFKA_BROKER,
+        'group.id': 'iot_consumer_group',
+        'auto.offset.reset': 'earliest',
+        'enable.auto.commit': False,  # 資料寫入成功後才手動提交 offset
+        'on_commit': on_commit,
+        'topic.metadata.refresh.interval.ms': TOPIC_METADATA_REFRESH_MS,
+        'fetch.min.bytes': KAFKA_FETCH_MIN_BYTES,
+        'fetch.wait.max.ms': KAFKA_FETCH_WAIT_MAX_MS,
+        'max.partition.fetch.bytes': KAFKA_MAX_PARTITION_FETCH_BYTES,
+        'queued.max.messages.kbytes': KAFKA_QUEUED_MAX_KBYTES,
+    }
+    consumer = Consumer(consumer_config)
+    flow_controller = FlowController(
+        FLOW_TARGET_LATENCY_MS / 1000, BATCH_SIZE, MIN_BATCH_SIZE, MAX_BATCH_SIZE,
+        BATCH_LINGER_SECONDS, MIN_LINGER_SECONDS, BATCH_LINGER_SECONDS,
+        MAX_IN_FLIGHT_ROWS, MAX_PARTITION_IN_FLIGHT_ROWS,
+    )
+    row_buffer = RowBuffer(flow_controller.batch_size, flow_controller.linger_seconds, offset_tracker)
+    last_lag_report_time = time.time()
+
+    def on_revoke(consumer, partitions):
+        """partition 被收回前先寫入並提交目前的資料，接手的 consumer 才不必重播"""
+        try:
+            release_parked_rows(row_buffer)
+            flush_row_buffer(row_buffer)
+        except Exception as e:
+            print(f"{datetime.now()} Failed to flush rows before rebalance: {e}")
+        try:
+            commit_processed(consumer, offset_tracker, asynchronous=False)
+        except KafkaException as e:
+            print(f"{datetime.now()} Failed to commit offsets before rebalance: {e}")
+        offset_tracker.forget(partitions)
+        flow_controller.forget((partition.topic, partition.partition) for partition in partitions)
+
+    consumer.subscribe([KAFKA_TOPIC_PATTERN], on_assign=on_assign, on_revoke=on_revoke)
+    spill_paused = False
+
+    while not stop_event.is_set():
+        try:
+            # spill 已滿時暫停所有 partition，只繼續寫入與提交，等 drainer 把 spill 清出空間
+            if spill_store and not spill_paused and spill_store.is_full():
+                spill_paused = True
+                print(f"{datetime.now()} Spill is full, pausing Kafka partitions")
+            elif spill_paused and not spill_store.is_full() and spill_store.usage() < 0.9:
+                spill_paused = False
+                print(f"{datetime.now()} Spill has room again, resuming Kafka partitions")
+            apply_flow_control(consumer, flow_controller, offset_tracker, hold_all=spill_paused)
+
+            # 有寫入中的批次時縮短等待，寫入完成後盡快提交 offset 並送出該 schema 的下一批
+            timeout = min(row_buffer.linger_seconds, WRITE_POLL_SECONDS) if row_buffer.writing else row_buffer.linger_seconds
+            with metrics.timer("poll_seconds"):
+                messages = consumer.consume(num_messages=row_buffer.batch_size, timeout=timeout)
+            metrics.increment("messages_consumed_total", len(messages))
+
+            for message in messages:
+                if message.error():
+                    print(f"{datetime.now()} Kafka consumer error: {message.error()}")
+                    continue
+
+                offset_tracker.consumed(message.topic(), message.partition(), message.offset())
+                try:
+                    process_message(message, row_buffer)
+                except Exception as e:
+                    metrics.increment("messages_failed_total", topic=message.topic())
+                    print(f"{datetime.now()} Failed to process message from {message.topic()}: {e}")
+                    reject_message(message, e, offset_tracker)
+
+            release_parked_rows(row_buffer)
+
+            # 不等待寫入中的批次：只處理已完成的，慢的 schema 不會擋住其他 schema 與消費
+            _, finished, _ = collect_writes(row_buffer)
+            if row_buffer.is_due():
+                submit_writes(row_buffer, full=row_buffer.size >= row_buffer.batch_size)
+
+            if finished:
+                # 只提交已寫入的部分；等待 DDL、寫入中或寫入失敗的資料列會擋住其後的 offset
+                commit_processed(consumer, offset_tracker)
+                if FLOW_CONTROL:
+                    now = time.time()
+                    for write in finished:
+                        flow_controller.record_flush(write.rows, now - write.first_row_time, now - write.started, write.full)
+                    row_buffer.batch_size = flow_controller.batch_size
+                    row_buffer.linger_seconds = flow_controller.linger_seconds
+
+            if time.time() - last_lag_report_time >= LAG_REPORT_INTERVAL:
+                report_consumer_lag(consumer)
+                last_lag_report_time = time.time()
 
         except KafkaException as e:
             print(f"{datetime.now()} Kafka error: {e}. Retrying in 5 seconds...")
@@ -364,88 +1456,559 @@ def consumer_worker():
         except Exception as e:
             print(f"{datetime.now()} Unexpected error in Kafka consumer: {e}")
 
-# 🚀 InfluxDB 資料寫入
-def write_to_influx_db(kafka_topic, inverter_brand, inverter_devicetype, data):
+    # 停止前把緩衝區寫完並提交 offset
+    flush_sinks(force=True)
     try:
-        influx_json = [{
-            "measurement": "sensor_data",
-            "tags": {
-                "device": data["serialnumber"],
-                "customer": data["customer_id"]
-            },
-            "time": data["collecttime"],
-            "fields": {k: float(v) for k, v in data.items() if isinstance(v, (int, float))}
-        }]
-        #influx_client.write_points(influx_json)
-        print(f"{datetime.now()} InfluxDB 寫入成功: {data}")
+        release_parked_rows(row_buffer)
+        flush_row_buffer(row_buffer)
     except Exception as e:
-        print(f"{datetime.now()} InfluxDB 寫入失敗: {e}")
+        print(f"{datetime.now()} Failed to flush remaining rows on shutdown: {e}")
+    try:
+        commit_processed(consumer, offset_tracker, asynchronous=False)
+    except Exception as e:
+        print(f"{datetime.now()} Failed to commit offsets on shutdown: {e}")
+    finally:
+        consumer.close()
+
+def apply_flow_control(consumer, flow_controller, offset_tracker, hold_all=False):
+    """依各 partition 尚未落地的資料列數暫停/恢復 partition，並更新流量控制指標"""
+    in_flight = offset_tracker.in_flight() if FLOW_CONTROL else {}
+    assignment = [(partition.topic, partition.partition) for partition in consumer.assignment()]
+    to_pause, to_resume = flow_controller.partitions_to_toggle(in_flight, assignment, hold_all)
+
+    if to_pause:
+        consumer.pause([TopicPartition(topic, partition) for topic, partition in to_pause])
+        metrics.increment("partitions_paused_total", len(to_pause))
+    if to_resume:
+        consumer.resume([TopicPartition(topic, partition) for topic, partition in to_resume])
+
+    worker = threading.current_thread().name
+    metrics.set_gauge("in_flight_rows", sum(in_flight.values()), worker=worker)
+    metrics.set_gauge("paused_partitions", len(flow_controller.paused), worker=worker)
+    metrics.set_gauge("flow_batch_size", flow_controller.batch_size, worker=worker)
+    metrics.set_gauge("flow_linger_seconds", flow_controller.linger_seconds, worker=worker)
+
+def reject_message(message, error, offset_tracker):
+    """無法解析的訊息原樣送進 dead-letter；未設定或送出失敗時寫入 REJECT_FILE
+
+    兩者都失敗時把這則訊息記為未完成，offset 不再前進，重啟或 rebalance 後會重新取得。
+    """
+    if DEAD_LETTER_TOPIC:
+        try:
+            send_to_dead_letter([(message.key(), message.value(), {"source_topic": message.topic(), "error": str(error)[:1000]})])
+            return
+        except Exception as e:
+            print(f"{datetime.now()} Failed to send message to dead-letter topic: {e}")
 
-def write_to_postgresql_db(kafka_topic,inverter_brand, inverter_devicetype, data):
-    """Function to write data into PostgreSQL."""
-    global postgres_schema_list
-    global column_cache 
+    try:
+        write_reject_message(message, error)
+    except Exception as e:
+        print(f"{datetime.now()} Failed to write message to {REJECT_FILE}, holding back offset "
+              f"{message.topic()}[{message.partition()}]@{message.offset()}: {e}")
+        offset_tracker.add_rows((message.topic(), message.partition(), message.offset()))
+
+def on_assign(consumer, partitions):
+    """記錄啟動後才出現的 topic，尚未有 schema 的客戶交給 DDL worker 在背景建立"""
+    new_topics = sorted({partition.topic for partition in partitions} - known_topics)
+    known_topics.update(new_topics)
+    for topic in new_topics:
+        kafka_topic_list.append(topic)
+        print(f"{datetime.now()} Subscribed to new Kafka topic {topic}")
+        if topic not in postgres_schemas:
+            provision_schema(topic)
+
+def report_consumer_lag(consumer):
+    """以本地快取的 high watermark 計算每個 partition 的 lag，不額外向 broker 查詢"""
+    for partition in consumer.position(consumer.assignment()):
+        if partition.offset < 0:
+            continue  # 尚未消費過的 partition 沒有 position
+        _, high = consumer.get_watermark_offsets(partition, cached=True)
+        metrics.set_gauge("consumer_lag", max(high - partition.offset, 0),
+                          topic=partition.topic, partition=partition.partition)
+
+def process_message(message, row_buffer):
+    """解析單筆 Kafka 訊息並放入寫入緩衝區，資料列記住來源 offset 供提交時判斷"""
+    with metrics.timer("decode_seconds"):
+        # 直接從 bytes 解析，並取出不寫入資料表的 inverter_brand/devicetype
+        inverter_brand, inverter_devicetype, data = decode_payload(decode_json, message.value())
+
+    kafka_topic = message.topic()
+    source = (kafka_topic, message.partition(), message.offset())
+
+    # 設備回報的錯誤碼優先，沒有錯誤 (0) 時才建立錯誤假資料
+    alarm_code = data.get("errormessage") or random.choice(ERROR_BITS)
+    write_to_postgresql_db(kafka_topic, inverter_brand, inverter_devicetype, data, row_buffer, source,
+                           alarm_code=alarm_code)
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def build_insert_statement(schema_name, table_name, columns, returning=()):
+    """建立多筆寫入用的 INSERT ... ON CONFLICT DO NOTHING 語句，returning 為要以 RETURNING 取回的欄位
+
+    依 (schema, table, 欄位 tuple) 快取，同型號設備的訊息幾乎都會命中；
+    命中率可由 statement_cache_info() 取得。
+    """
+    target = table_clause(table_name, *[column_clause(k) for k in columns], schema=schema_name)
+    statement = insert(target).on_conflict_do_nothing(index_elements=list(DEDUP_COLUMNS))
+    return statement.returning(*[target.c[k] for k in returning]) if returning else statement
+
+def statement_cache_info():
+    """回傳 INSERT 語句快取的命中/未命中次數與大小"""
+    info = build_insert_statement.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+
+def hit_rate(hits, misses):
+    return hits / (hits + misses) if hits + misses else 0.0
+
+def cache_metrics():
+    statement_info = statement_cache_info()
+    return {
+        ("statement_cache_hit_rate", ()): hit_rate(statement_info["hits"], statement_info["misses"]),
+        ("column_cache_hit_rate", ()): hit_rate(column_cache_stats["hits"], column_cache_stats["misses"]),
+    }
 
-    schema_name = kafka_topic
+metrics.register_collector(cache_metrics)
 
-    if schema_name not in postgres_schema_list:
-        create_schema(schema_name)
-        create_table(schema_name, "inverter")
-        create_table(schema_name, "alarm")
+def copy_rows(connection, schema_name, table_name, columns, rows, staging_name, returning=()):
+    """以 COPY 將資料串流進暫存表，再 INSERT ... SELECT 進目標表，仍由 (serialnumber, collecttime) 唯一約束去重
 
-    missing_columns = set(data.keys()) - column_cache[schema_name]["inverter"]
-    
-    if missing_columns:
-        create_columns(schema_name, "inverter", data)  # 創建缺少的欄位
-        create_index(schema_name, "inverter")
-        create_constraints(schema_name, "inverter")
-        column_cache[schema_name]["inverter"].update(missing_columns)  # 更新快取
+    指定 returning 時回傳實際寫入的資料列的這些欄位。
+    """
+    column_list = ', '.join([f'"{k}"' for k in columns])
 
-    if data["errormessage"] == 0:
-        with engine.begin() as connection:
-            insert_query = text(f"""
-                INSERT INTO "{schema_name}"."{"inverter"}" 
-                ({', '.join([f'"{k}"' for k in data.keys()])}) 
-                VALUES ({', '.join([f':{k}' for k in data.keys()])})
-                ON CONFLICT ("collecttime") DO NOTHING
-            """)
-            connection.execute(insert_query, data)
+    csv_buffer = io.StringIO()
+    writer = csv.writer(csv_buffer)
+    for row in rows:
+        writer.writerow(['\\N' if row[k] is None else row[k] for k in columns])
+    csv_buffer.seek(0)
 
-            print(f"{datetime.now()} Inserted data into {schema_name}.inverter")
-        return 
+    cursor = connection.connection.cursor()
+    try:
+        # 暫存表只保留本批欄位，交易結束時自動刪除
+        cursor.execute(f"""
+            CREATE TEMP TABLE "{staging_name}" ON COMMIT DROP AS
+            SELECT {column_list} FROM "{schema_name}"."{table_name}" WITH NO DATA
+        """)
+        cursor.copy_expert(
+            f"""COPY "{staging_name}" ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '\\N')""",
+            csv_buffer
+        )
+        returning_clause = "RETURNING " + ', '.join([f'"{k}"' for k in returning]) if returning else ""
+        cursor.execute(f"""
+            INSERT INTO "{schema_name}"."{table_name}" ({column_list})
+            SELECT {column_list} FROM "{staging_name}"
+            ON CONFLICT ("serialnumber", "collecttime") DO NOTHING
+            {returning_clause}
+        """)
+        return cursor.fetchall() if returning else None
+    finally:
+        cursor.close()
+
+def resolve_alarms(connection, schema_name, rows):
+    """以一個 UPDATE ... FROM (VALUES ...) 批次解除告警，找不到未解除告警的筆數記入 alarm_resolutions_unmatched_total"""
+    values = []
+    params = {}
+    for index, row in enumerate(rows):
+        values.append(f"(:serialnumber_{index}, CAST(:collecttime_{index} AS TIMESTAMP), "
+                      f"CAST(:recoverytime_{index} AS TIMESTAMP), :duration_{index})")
+        params[f"serialnumber_{index}"] = row["serialnumber"]
+        params[f"collecttime_{index}"] = row["collecttime"]
+        params[f"recoverytime_{index}"] = row["alertrecoverytime"]
+        params[f"duration_{index}"] = row["alertduration"]
+
+    result = connection.execute(text(f"""
+        UPDATE "{schema_name}"."alarm" AS a
+        SET alertstatus = 'resolved', alertrecoverytime = v.recoverytime, alertduration = v.duration
+        FROM (VALUES {", ".join(values)}) AS v (serialnumber, collecttime, recoverytime, duration)
+        WHERE a.serialnumber = v.serialnumber AND a.collecttime = v.collecttime AND a.alertstatus = 'unresolved'
+    """), params)
+    if result.rowcount < len(rows):
+        metrics.increment("alarm_resolutions_unmatched_total", len(rows) - result.rowcount, schema=schema_name)
+
+def ensure_rollup_tables(schema_name):
+    """由 DDL worker 在 inverter 表開放寫入前建立彙總表"""
+    if schema_name in rollup_tables:
+        return
 
-    if inverter_brand == "goodwe"  and data["errormessage"] != 0:
-        data = GoodWe(inverter_devicetype).get_error_message(data)
- 
-    missing_columns = set(data.keys()) - column_cache[schema_name]["alarm"]
-    
-    if missing_columns:
-        create_columns(schema_name, "alarm", data)  # 創建缺少的欄位
-        create_index(schema_name, "alarm")
-        create_constraints(schema_name, "alarm")
-        column_cache[schema_name]["alarm"].update(missing_columns)  # 更新快取
-
-    # Default case to insert into PostgreSQL
-    if data["errormessage"] != 0:
-        with engine.begin() as connection:
-            insert_query = text(f"""
-                INSERT INTO "{schema_name}"."{"alarm"}" 
-                ({', '.join([f'"{k}"' for k in data.keys()])}) 
-                VALUES ({', '.join([f':{k}' for k in data.keys()])})
-                ON CONFLICT ("collecttime") DO NOTHING
-            """)
-            connection.execute(insert_query, data)
+    with ddl_engine.begin() as connection:
+        create_rollup_tables(connection, schema_name)
+    rollup_tables.add(schema_name)
+    print(f"{datetime.now()} Rollup tables {', '.join(ROLLUP_INTERVALS)} ready in schema '{schema_name}'.")
 
-            print(f"{datetime.now()} Inserted data into {schema_name}.alarm")        
+def rollup_returning(table_name, columns):
+    """inverter 分組寫入時以 RETURNING 取回的欄位 (serialnumber、collecttime 與要彙總的欄位)，不需彙總時為空"""
+    if not ROLLUPS or table_name != "inverter":
+        return ()
+    fields = rollup_fields(columns)
+    return DEDUP_COLUMNS + fields if fields else ()
 
+def flush_schema_groups(schema_name, groups):
+    """在單一交易內寫入同一個 schema 的所有分組，以及這些資料的彙總增量
 
-def start_kafka_consumer():
+    彙總增量由 INSERT ... RETURNING 取回的資料列計算，唯一約束略過的重複資料不會計入；
+    彙總表與原始資料在同一個交易中提交或回滾，重試與重播都不會重複計算。
+    分區表的分區與彙總表在資料列移入批次前已由 DDL worker 建立。
+    """
+    # 告警解除排在最後，同一批新增的告警資料列寫入後才更新
+    groups = sorted(groups, key=lambda group: group[0][1] == ALARM_RESOLUTION)
+
+    rollups = {}
+    with metrics.timer("insert_seconds"), engine.begin() as connection:
+        for index, ((_, table_name, columns), rows) in enumerate(groups):
+            returning = rollup_returning(table_name, columns)
+            if table_name == ALARM_RESOLUTION:
+                resolve_alarms(connection, schema_name, rows)
+                continue
+            if PG_INGEST_MODE == "copy":
+                inserted = copy_rows(connection, schema_name, table_name, columns, rows, f"staging_{table_name}_{index}", returning)
+            else:
+                inserted = connection.execute(build_insert_statement(schema_name, table_name, columns, returning), rows)
+            if returning:
+                accumulate(rollups, inserted, returning[len(DEDUP_COLUMNS):])
+        if rollups:
+            upsert_rollups(connection, schema_name, rollups)
+
+    for (_, table_name, _), rows in groups:
+        if table_name == ALARM_RESOLUTION:
+            metrics.increment("alarms_resolved_total", len(rows), schema=schema_name)
+        else:
+            metrics.increment("rows_inserted_total", len(rows), schema=schema_name, table=table_name)
+
+def submit_writes(row_buffer, full=False):
+    """把緩衝區的分組依 schema 交給 db_write_executor，不等待寫入完成
+
+    每個 schema 同時只有一個寫入中的批次 (各自一個交易)；寫入中的 schema 新進的資料留在緩衝區，
+    上一批完成後才送出，同一個 schema 的寫入順序不變。某個客戶的鎖等待不會拖慢其他客戶，consumer 也繼續消費。
+    連續失敗 FLUSH_MAX_RETRIES 次的分組不再放進 schema 的交易 (不拖累同 schema 的其他分組)，
+    改為單獨以 write_or_reject 寫入並找出寫不進去的資料列。
+    """
+    keys_by_schema = {}
+    for key in row_buffer.groups:
+        if key[0] not in row_buffer.writing:
+            keys_by_schema.setdefault(key[0], []).append(key)
+
+    first_row_time = row_buffer.first_row_time
+    for schema_name, keys in keys_by_schema.items():
+        batch = row_buffer.take(keys)
+        if spill_store and spill_store.has_segments(schema_name):
+            # 還有資料在 spill 等待重播時，新的批次也排在後面，維持同一個 schema 的寫入順序
+            try:
+                spill_schema(row_buffer, schema_name, batch)
+            except SpillFull:
+                row_buffer.restore(batch)  # spill 已滿時 consumer 暫停所有 partition，等 drainer 清出空間
+            except Exception:
+                row_buffer.restore(batch)
+                raise
+            continue
+
+        groups = [entry for entry in batch if row_buffer.failures.get(entry[0], 0) < FLUSH_MAX_RETRIES]
+        isolated = [entry for entry in batch if row_buffer.failures.get(entry[0], 0) >= FLUSH_MAX_RETRIES]
+        future = db_write_executor.submit(write_schema_batch, schema_name,
+                                          [(key, rows) for key, rows, _ in groups],
+                                          [(key, rows) for key, rows, _ in isolated])
+        row_buffer.writing[schema_name] = SchemaWrite(future, groups, isolated, first_row_time, full)
+
+def write_schema_batch(schema_name, groups, isolated):
+    """在 db-writer 執行緒寫入一個 schema 的批次，回傳 (groups 的例外, {isolated 分組 key: 例外})
+
+    groups 在一個交易中寫入；isolated 為多次失敗的分組，逐一以 write_or_reject 寫入，
+    寫不進去的資料列送往 dead-letter/reject 檔，資料庫無法連線時回傳例外、保留分組。
+    """
+    error = None
+    if groups:
+        try:
+            flush_schema_groups(schema_name, groups)
+        except Exception as e:
+            error = e
 
-    consumer_thread = threading.Thread(target=consumer_worker, daemon=True)
-    consumer_thread.start()
+    isolated_errors = {}
+    for key, rows in isolated:
+        try:
+            write_or_reject(schema_name, key, rows)
+        except Exception as e:
+            isolated_errors[key] = e
+    return error, isolated_errors
+
+def collect_writes(row_buffer, wait=False):
+    """處理已完成的寫入 (wait 為 True 時等待全部完成)，回傳 (寫入筆數, 完成的 SchemaWrite, 要重試的例外)
+
+    寫入成功的分組讓來源 offset 可以提交；資料庫無法連線時改寫入 spill，其他失敗放回緩衝區並累計失敗次數，
+    這些資料的 offset 不會被提交。
+    """
+    inserted = 0
+    finished = []
+    retry_error = None
+    for schema_name, write in list(row_buffer.writing.items()):
+        if not wait and not write.future.done():
+            continue
+        del row_buffer.writing[schema_name]
+        finished.append(write)
+        error, isolated_errors = write.future.result()
+
+        if error is None:
+            inserted += sum(len(rows) for _, rows, _ in write.groups)
+            row_buffer.complete(write.groups)
+            if spill_store:
+                spill_store.clear_rejected()
+        else:
+            print(f"{datetime.now()} Failed to write batch into schema '{schema_name}': {error}")
+            spilled = False
+            if spill_store and database_unavailable(error):
+                try:
+                    inserted += spill_schema(row_buffer, schema_name, write.groups)
+                    spilled = True
+                except Exception as e:
+                    print(f"{datetime.now()} Cannot spill batch for schema '{schema_name}': {e}")
+            if not spilled:
+                for key, _, _ in write.groups:
+                    row_buffer.failures[key] = row_buffer.failures.get(key, 0) + 1
+                    if row_buffer.failures[key] < FLUSH_MAX_RETRIES:
+                        retry_error = retry_error or error  # 達到上限的分組下次單獨寫入
+                row_buffer.restore(write.groups)
+
+        for entry in write.isolated:
+            key, rows, _ = entry
+            isolated_error = isolated_errors.get(key)
+            if isolated_error is None:
+                inserted += len(rows)
+                row_buffer.complete([entry])
+            else:
+                print(f"{datetime.now()} Failed to write isolated group for '{key[0]}.{key[1]}': {isolated_error}")
+                row_buffer.restore([entry])
+    return inserted, finished, retry_error
+
+def flush_row_buffer(row_buffer):
+    """寫入緩衝區內所有資料並等待完成 (rebalance 與結束前使用)，回傳寫入筆數
+
+    先等寫入中的批次完成，再送出其餘資料並等待；仍有分組寫入失敗時拋出例外，這些資料留在緩衝區。
+    """
+    inserted, _, _ = collect_writes(row_buffer, wait=True)
+    submit_writes(row_buffer)
+    more, _, error = collect_writes(row_buffer, wait=True)
+    if error:
+        raise error
+    return inserted + more
+
+def database_unavailable(error):
+    """連線失敗、逾時或連線池等不到連線，資料本身沒有問題，改寫入 spill 而不是重試/dead-letter"""
+    return isinstance(error, (sqlalchemy_exc.OperationalError, sqlalchemy_exc.InterfaceError, sqlalchemy_exc.TimeoutError))
+
+def spill_schema(row_buffer, schema_name, batch):
+    """把一個 schema 的批次 [(key, rows, sources)] 寫入 spill，之後由 drainer 寫入資料庫 (同時計算彙總值)；
+    寫入 spill 後即可提交 offset"""
+    spill_store.write(schema_name, [(key, rows) for key, rows, _ in batch])
+
+    spilled = sum(len(rows) for _, rows, _ in batch)
+    row_buffer.complete(batch)
+    metrics.increment("rows_spilled_total", spilled, schema=schema_name)
+    return spilled
+
+def start_spill_store():
+    global spill_store
+    if spill_store is None and SPILL_DIR and SPILL_MAX_BYTES:
+        spill_store = SpillStore(SPILL_DIR, SPILL_MAX_BYTES)
+        print(f"{datetime.now()} Spilling batches to {SPILL_DIR} while the database is unavailable "
+              f"(up to {SPILL_MAX_BYTES} bytes)")
+
+def read_spill(paths):
+    """讀取 segment；無法解析的 segment 移到隔離區 (改名為 .bad)，回傳 (可重播的 paths, groups)"""
+    try:
+        return paths, spill_store.read(paths)
+    except (ValueError, KeyError):
+        pass
+
+    readable = []
+    for path in paths:
+        try:
+            spill_store.read([path])
+        except (ValueError, KeyError) as e:
+            spill_store.quarantine([path])
+            metrics.increment("spill_segments_quarantined_total", schema=path.parent.name)
+            print(f"{datetime.now()} Quarantined unreadable spill segment {path}: {e}")
+            continue
+        readable.append(path)
+    return readable, spill_store.read(readable)
+
+def drain_spill():
+    """依序重播每個 schema 的 spill segment，多個 segment 合併成一個交易寫入
+
+    資料庫無法連線時保留 segment 稍後重試；因資料本身寫不進去而失敗時改為逐一分組以 write_or_reject 寫入，
+    寫不進去的資料列送往 dead-letter/reject 檔，segment 不會卡住後面的資料。
+    """
+    drained = 0
+    for schema_name in spill_store.schemas():
+        paths = spill_store.segments(schema_name, SPILL_DRAIN_BATCH)
+        if not paths:
+            continue
+
+        paths, groups = read_spill(paths)
+        if not paths:
+            continue
+
+        # 重啟後 DDL worker 可能還沒建好表 (例如新開啟 ROLLUPS 時的彙總表)，準備好之前先不重播
+        waiting = {column_table(table_name) for _, table_name, _ in groups
+                   if (schema_name, column_table(table_name)) not in table_setup_done}
+        if waiting:
+            for table_name in waiting:
+                request_columns(schema_name, table_name, {})
+            continue
+
+        try:
+            flush_schema_groups(schema_name, list(groups.items()))
+        except Exception as e:
+            if database_unavailable(e):
+                raise
+            print(f"{datetime.now()} Failed to replay spill for schema '{schema_name}', writing groups one by one: {e}")
+            for key, rows in groups.items():
+                write_or_reject(schema_name, key, rows)
+        spill_store.remove(paths)
+
+        rows = sum(len(rows) for rows in groups.values())
+        metrics.increment("rows_drained_total", rows, schema=schema_name)
+        drained += rows
+    return drained
+
+def spill_drainer():
+    while not stop_event.is_set():
+        try:
+            drained = drain_spill()
+        except Exception as e:
+            print(f"{datetime.now()} Failed to drain spill: {e}. Retrying in {SPILL_DRAIN_INTERVAL} seconds...")
+            drained = 0
+        if not drained:
+            stop_event.wait(SPILL_DRAIN_INTERVAL)
+
+def spill_metrics():
+    return {("spill_bytes", ()): spill_store.size} if spill_store else {}
+
+metrics.register_collector(spill_metrics)
+
+def write_or_reject(schema_name, key, rows):
+    """寫入失敗時對半切分各自寫入，直到找出單筆寫不進去的資料列並 reject_rows，其餘照常寫入"""
+    try:
+        flush_schema_groups(schema_name, [(key, rows)])
+        return len(rows)
+    except Exception as e:
+        if database_unavailable(e):
+            raise
+        if len(rows) == 1:
+            reject_rows(schema_name, key[1], rows, e)
+            return 0
+
+    middle = len(rows) // 2
+    return write_or_reject(schema_name, key, rows[:middle]) + write_or_reject(schema_name, key, rows[middle:])
+
+def write_to_postgresql_db(kafka_topic,inverter_brand, inverter_devicetype, data, row_buffer, source=None, alarm_code=None):
+    """Function to write data into PostgreSQL.
+
+    每則訊息只路由一次，分成 inverter 與/或 alarm 資料列 (及告警解除)，都放入同一個 row_buffer，
+    由 flush_row_buffer 在同一批、同一個 schema 交易中寫入；缺少欄位的資料先暫存，等 DDL worker 新增欄位。
+    alarm_code 為告警路徑使用的錯誤碼，預設為 data 的 errormessage。
+    ALARM_LIFECYCLE 開啟時只有新出現的錯誤 bit 會產生告警資料列，bit 消失時排入告警解除；
+    告警表沒有 alertstatus 欄位的 schema 無法記錄解除，照常寫入每一筆告警。
+    """
+    schema_name = kafka_topic
+    if alarm_code is None:
+        alarm_code = data["errormessage"]
+
+    if invalid_row_reason(data) is not None:
+        # 不進入告警狀態與 sink，暫存後由 release_parked_rows 與其他無法寫入的資料列一起送往 dead-letter/reject 檔
+        row_buffer.track(source)
+        row_buffer.park(schema_name, "inverter" if data["errormessage"] == 0 else "alarm", dict(data), source, recheck=True)
+        return
+
+    if data["errormessage"] == 0:
+        buffer_row(row_buffer, schema_name, "inverter", data, source)
+
+    lifecycle = ALARM_LIFECYCLE and data.get("serialnumber") is not None and tracks_alarm_lifecycle(schema_name, inverter_brand)
+    if lifecycle:
+        raised_code, resolved = alarm_tracker.observe(schema_name, data["serialnumber"], alarm_code, data.get("collecttime"))
+        for alert_time, recovery_time, duration in resolved:
+            buffer_row(row_buffer, schema_name, ALARM_RESOLUTION, {
+                "serialnumber": data["serialnumber"],
+                "collecttime": alert_time,
+                "alertrecoverytime": recovery_time,
+                "alertduration": duration,
+            }, source)
+
+        if alarm_code != 0 and not raised_code:
+            metrics.increment("alarms_suppressed_total", schema=schema_name)
+            return  # 告警仍在持續中，不重複寫入
+        alarm_code = raised_code  # 告警資料列只記錄這次新出現的 bit
+
+    if alarm_code == 0:
+        return
+
+    alarm = {**data, "errormessage": alarm_code}
+    if inverter_brand == "goodwe":
+        with metrics.timer("enrichment_seconds"):
+            alarm = goodwe_for(inverter_devicetype).get_error_message(alarm)
+    if lifecycle:
+        alarm.setdefault("alertstatus", "unresolved")  # 重建狀態與告警解除都依 alertstatus 找出未解除的告警
+
+    buffer_row(row_buffer, schema_name, "alarm", alarm, source)
+
+def tracks_alarm_lifecycle(schema_name, inverter_brand):
+    """告警表已有 alertstatus 欄位，或這則告警本身會帶有 alertstatus (goodwe) 時才追蹤告警生命週期"""
+    if inverter_brand == "goodwe":
+        return True
+    return "alertstatus" in column_cache.get(schema_name, {}).get("alarm", ())
+
+def alarm_parked(row_buffer, schema_name, serial_number, alert_time):
+    """告警解除對應的告警資料列還在等待 DDL worker 時回傳 True"""
+    return any(table_name == "alarm" and data.get("serialnumber") == serial_number
+               and str(data.get("collecttime")) == alert_time
+               for _, table_name, data, _ in row_buffer.parked.get((schema_name, "alarm"), ()))
+
+def buffer_row(row_buffer, schema_name, table_name, data, source=None):
+    if DEDUP_CACHE_SIZE and data.get("serialnumber") is not None:
+        if recent_keys.seen(dedup_key(schema_name, table_name, data)):
+            metrics.increment("duplicates_dropped_total", schema=schema_name, table=table_name)
+            return
+
+    data = dict(data)  # 複製一份，避免後續修改 data 影響緩衝區
+    row_buffer.track(source)
+
+    if table_name != ALARM_RESOLUTION:
+        for sink in sinks:
+            sink.write(schema_name, table_name, data)
+
+    if table_name == ALARM_RESOLUTION and alarm_parked(row_buffer, schema_name, data["serialnumber"], data["collecttime"]):
+        row_buffer.park(schema_name, table_name, data, source)  # 告警寫入後才能解除
+    elif columns_ready(schema_name, column_table(table_name), data):
+        row_buffer.add(schema_name, table_name, data, source)
+    else:
+        row_buffer.park(schema_name, table_name, data, source)
+
+def start_kafka_consumer(num_workers=CONSUMER_WORKERS):
+    """啟動多個 consumer worker，每個 worker 各自持有一個同 group 的 Consumer
+
+    Kafka 會把 partition 分配給各 worker，同一 partition 只會由一個 worker 依序處理，
+    因此只要 producer 以 datalogger 作為 message key，同一台 datalogger 的資料順序不變。
+    """
+    print(f"{datetime.now()} Decoding Kafka messages with {json_decoder_name}")
+    start_ddl_workers()
+    start_spill_store()
+    metrics.start_metrics_logger(METRICS_LOG_INTERVAL)
+    if METRICS_PORT:
+        metrics.start_metrics_server(METRICS_PORT)
+    if PARTITIONED_TABLES or partitioned_tables:
+        threading.Thread(target=partition_maintenance_worker, name="partition-maintenance", daemon=True).start()
+    if spill_store:
+        threading.Thread(target=spill_drainer, name="spill-drainer", daemon=True).start()
+
+    consumer_threads = []
+
+    for index in range(num_workers):
+        consumer_thread = threading.Thread(target=consumer_worker, name=f"consumer-worker-{index}", daemon=True)
+        consumer_thread.start()
+        consumer_threads.append(consumer_thread)
+
+    return consumer_threads
 
 if __name__ == "__main__":
     
+    consumer_threads = []
+
     try:
 
         list_kafka_topics()
@@ -453,11 +2016,21 @@ if __name__ == "__main__":
 
         setup_postgres_from_kafka()
         check_and_update_schema_tables()
+        migrate_dedup_constraints()
+        if ALARM_LIFECYCLE:
+            rebuild_alarm_state()
 
-        start_kafka_consumer()
+        consumer_threads = start_kafka_consumer()
 
         while True:
             time.sleep(1)
 
+    except KeyboardInterrupt:
+        print(f"{datetime.now()} Stopping Kafka consumers...")
+        stop_event.set()
+        for consumer_thread in consumer_threads:
+            consumer_thread.join()
+        close_sinks()
+
     except Exception as e:
         print(f"{datetime.now()} An error occurred: {e}")
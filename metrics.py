@@ -0,0 +1,163 @@
+from datetime import datetime
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+# 延遲直方圖的區間上限 (秒)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+metrics_lock = threading.Lock()
+
+counters = {}  # (名稱, labels) -> 累計值
+gauges = {}  # (名稱, labels) -> 目前值
+histograms = {}  # (名稱, labels) -> [各區間次數..., 總和, 次數]
+
+collectors = []  # 輸出前呼叫的函式，回傳 {(名稱, labels): 值} 形式的 gauge (例如快取命中率)
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def increment(name, amount=1, **labels):
+    key = (name, label_key(labels))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + amount
+
+def set_gauge(name, value, **labels):
+    with metrics_lock:
+        gauges[(name, label_key(labels))] = value
+
+def observe(name, seconds, **labels):
+    """記錄一次延遲 (秒) 到直方圖"""
+    key = (name, label_key(labels))
+    index = bisect_left(LATENCY_BUCKETS, seconds)
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 3)
+        histogram[index] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+@contextmanager
+def timer(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+def register_collector(collector):
+    collectors.append(collector)
+
+def collect_gauges():
+    collected = {}
+    for collector in collectors:
+        for (name, labels), value in collector().items():
+            collected[(name, label_key(dict(labels)))] = value
+    return collected
+
+def snapshot():
+    with metrics_lock:
+        return dict(counters), dict(gauges), {key: list(value) for key, value in histograms.items()}
+
+def format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+def render_prometheus():
+    """以 Prometheus text format 輸出所有指標"""
+    counter_values, gauge_values, histogram_values = snapshot()
+    gauge_values.update(collect_gauges())
+    lines = []
+
+    for (name, labels), value in sorted(counter_values.items()):
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+    for (name, labels), value in sorted(gauge_values.items()):
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+    for (name, labels), histogram in sorted(histogram_values.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram[-1]}")
+        lines.append(f"{name}_sum{format_labels(labels)} {histogram[-2]}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram[-1]}")
+
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # 不輸出每次抓取的 access log
+
+def start_metrics_server(port):
+    """在本機 port 提供 /metrics (Prometheus 格式)"""
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"{datetime.now()} Metrics endpoint listening on :{port}/metrics")
+    return server
+
+def summary_line(previous, elapsed):
+    """整理一行摘要：各表每秒寫入筆數、各階段平均延遲、快取命中率與最大 consumer lag"""
+    counter_values, gauge_values, histogram_values = snapshot()
+    gauge_values.update(collect_gauges())
+    parts = []
+
+    for (name, labels), value in sorted(counter_values.items()):
+        if name == "rows_inserted_total":
+            label_values = dict(labels)
+            rate = (value - previous.get((name, labels), 0)) / elapsed
+            parts.append(f"{label_values['schema']}.{label_values['table']}={rate:.1f}rows/s")
+
+    stage_totals = {}
+    for (name, labels), histogram in histogram_values.items():
+        total = stage_totals.setdefault(name, [0.0, 0])
+        total[0] += histogram[-2]
+        total[1] += histogram[-1]
+    for name, (seconds, count) in sorted(stage_totals.items()):
+        if count:
+            parts.append(f"{name}_avg={seconds / count * 1000:.2f}ms")
+
+    for (name, labels), value in sorted(gauge_values.items()):
+        if name.endswith("hit_rate"):
+            parts.append(f"{name}={value:.3f}")
+
+    lags = [value for (name, _), value in gauge_values.items() if name == "consumer_lag"]
+    if lags:
+        parts.append(f"max_consumer_lag={max(lags)}")
+
+    return " ".join(parts), counter_values
+
+def metrics_logger(interval):
+    previous = {}
+    last_time = time.time()
+    while True:
+        time.sleep(interval)
+        now = time.time()
+        line, previous = summary_line(previous, now - last_time)
+        last_time = now
+        if line:
+            print(f"{datetime.now()} Metrics: {line}")
+
+def start_metrics_logger(interval):
+    """每 interval 秒輸出一行指標摘要，取代逐筆寫入時的 print"""
+    threading.Thread(target=metrics_logger, args=(interval,), name="metrics-logger", daemon=True).start()
@@ -1,4 +1,6 @@
 from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType
 
 WORK_MODE_MAP = {
     0: "cWaitMode - 等待、自檢模式",
@@ -28,6 +30,106 @@ GPRS_BURN_IN_MODE_MAP = {
     1: "Burn-in Mode - 老化模式",
 }
 
+# GoodWe 錯誤碼 (Error Message) 對應表，每個 bit 代表一種錯誤
+ERROR_MESSAGE_MAP = MappingProxyType({
+    2147483648: "SPI Fail - 內部通訊異常",
+    1073741824: "EEPROM R/W Fail - 存儲讀寫異常",
+    536870912: "Fac Fail - 電網頻率超限",
+    268435456: "AFCI Fault - 直流拉弧故障",
+    134217728: "Night SPS Fault - 夜間 SPS 異常",
+    67108864: "L-PE Fail - 火線對地短路",
+    33554432: "Relay Chk Fail - 繼電器自檢異常",
+    16777216: "N-PE Fail - N 線對地異常",
+    8388608: "ARCFail-HW - 硬件防逆流故障",
+    4194304: "Pv Reverse Fault - PV 反接故障",
+    2097152: "String OverCurr - 组串电流过流",
+    1048576: "LCD Comm Fail - LCD 通訊異常",
+    524288: "DCI High - 直流分量高",
+    262144: "Isolation Fail - 绝缘阻抗低",
+    131072: "Vac Fail - 電網電壓超限",
+    65536: "EFan Fail - 外風扇異常",
+    32768: "PV Over Voltage - 面板電壓過高",
+    8192: "Overtemp - 過溫保護",
+    4096: "IFan Fail - 內風扇異常",
+    2048: "DC Bus High - 母線電壓高",
+    1024: "Ground I Fail - 殘餘電流保護",
+    512: "Utility Loss - 電網斷電",
+    256: "AC HCT Fail - 交流傳感器故障",
+    128: "Relay Dev Fail - 繼電器故障",
+    64: "GFCI Fail - 漏電流設備故障",
+    16: "DC SPD Fail - 直流防雷失效",
+    8: "DC Switch Fail - 直流開關超限",
+    4: "Ref 1.5V Fail - 1.5V 基準超限",
+    2: "AC HCT Chk Fail - 交流自檢異常",
+    1: "GFCI Chk Fail - 漏電流自檢異常",
+})
+
+ERROR_BITS = tuple(ERROR_MESSAGE_MAP)
+
+UNKNOWN_ALERT_LEVEL = "未知等級"
+
+# 告警等級由低到高
+ALERT_LEVELS = ("low", "medium", "high", "severe")
+ALERT_LEVEL_NAMES = {
+    "severe": "嚴重警告",
+    "high": "重要警告",
+    "medium": "次要警告",
+    "low": "提示",
+}
+
+TEXT_TYPE = "CHARACTER VARYING(125)"
+TIMESTAMP_TYPE = "TIMESTAMP WITHOUT TIME ZONE"
+
+# 已知欄位的 PostgreSQL 型別，不必由樣本值推斷 (例如夜間 0 發電量不會把功率欄位建成 INTEGER)
+COLUMN_TYPES = MappingProxyType({
+    # 識別與時間
+    "serialnumber": TEXT_TYPE,
+    "devicetype": TEXT_TYPE,
+    "devicename": TEXT_TYPE,
+    "collecttime": TIMESTAMP_TYPE,
+    # 狀態碼：WORK_MODE_MAP / FUNCTION_BIT_MAP / GPRS_BURN_IN_MODE_MAP / ERROR_MESSAGE_MAP
+    "workmode": "INTEGER",
+    "functionbit": "INTEGER",
+    "gprsburninmode": "INTEGER",
+    "errormessage": "BIGINT",  # 32 個錯誤 bit，最高位超過 INTEGER 範圍
+    "warningcode": "BIGINT",
+    # GoodWe.get_error_message 產生的告警欄位
+    "alertlevel": TEXT_TYPE,
+    "alertstatus": TEXT_TYPE,
+    "alertcontent": TEXT_TYPE,
+    "alerttime": TIMESTAMP_TYPE,
+    "alertduration": TEXT_TYPE,
+    "alertrecoverytime": TIMESTAMP_TYPE,
+    "handler": TEXT_TYPE,
+    "handlingtime": TIMESTAMP_TYPE,
+    "relatedworkorder": TEXT_TYPE,
+    "action": TEXT_TYPE,
+    # 量測值
+    "temperature": "DOUBLE PRECISION",
+})
+
+# 依欄位名稱結尾決定型別的量測欄位 (pv1voltage、iac1current、totalpower、dailyenergy 等)
+COLUMN_TYPE_SUFFIXES = (
+    ("time", TIMESTAMP_TYPE),
+    ("voltage", "FLOAT"),
+    ("current", "FLOAT"),
+    ("power", "FLOAT"),
+    ("energy", "FLOAT"),
+    ("frequency", "FLOAT"),
+)
+
+@lru_cache(maxsize=None)
+def column_type_for(field):
+    """已知欄位或已知結尾的欄位型別；未知欄位回傳 None，由呼叫端依樣本值決定"""
+    column_type = COLUMN_TYPES.get(field)
+    if column_type is not None:
+        return column_type
+
+    for suffix, suffix_type in COLUMN_TYPE_SUFFIXES:
+        if field.endswith(suffix):
+            return suffix_type
+    return None
+
 class GoodWe:
     ERROR_SEVERITY = {
         "severe": {2147483648, 1073741824, 536870912, 268435456},  # 嚴重警告
@@ -35,54 +137,16 @@ class GoodWe:
         "medium": {2097152, 1048576, 524288, 262144, 131072, 65536},  # 次要警告
         "low": {32768, 8192, 4096, 2048, 1024, 512, 256, 128, 64, 16, 8, 4, 2, 1}  # 提示
         }
+
+    ERROR_MESSAGE_MAP = ERROR_MESSAGE_MAP
+
     def __init__(self, devicetype):
         
         self.devicetype = devicetype    
 
-        self.ERROR_MESSAGE_MAP = {
-            2147483648: "SPI Fail - 內部通訊異常",
-            1073741824: "EEPROM R/W Fail - 存儲讀寫異常",
-            536870912: "Fac Fail - 電網頻率超限",
-            268435456: "AFCI Fault - 直流拉弧故障",
-            134217728: "Night SPS Fault - 夜間 SPS 異常",
-            67108864: "L-PE Fail - 火線對地短路",
-            33554432: "Relay Chk Fail - 繼電器自檢異常",
-            16777216: "N-PE Fail - N 線對地異常",
-            8388608: "ARCFail-HW - 硬件防逆流故障",
-            4194304: "Pv Reverse Fault - PV 反接故障",
-            2097152: "String OverCurr - 组串电流过流",
-            1048576: "LCD Comm Fail - LCD 通訊異常",
-            524288: "DCI High - 直流分量高",
-            262144: "Isolation Fail - 绝缘阻抗低",
-            131072: "Vac Fail - 電網電壓超限",
-            65536: "EFan Fail - 外風扇異常",
-            32768: "PV Over Voltage - 面板電壓過高",
-            8192: "Overtemp - 過溫保護",
-            4096: "IFan Fail - 內風扇異常",
-            2048: "DC Bus High - 母線電壓高",
-            1024: "Ground I Fail - 殘餘電流保護",
-            512: "Utility Loss - 電網斷電",
-            256: "AC HCT Fail - 交流傳感器故障",
-            128: "Relay Dev Fail - 繼電器故障",
-            64: "GFCI Fail - 漏電流設備故障",
-            16: "DC SPD Fail - 直流防雷失效",
-            8: "DC Switch Fail - 直流開關超限",
-            4: "Ref 1.5V Fail - 1.5V 基準超限",
-            2: "AC HCT Chk Fail - 交流自檢異常",
-            1: "GFCI Chk Fail - 漏電流自檢異常",
-        }
-
     def classify_alert_level(self, error_code):
-        """根據 `error_code` 分類告警等級"""
-        for level, codes in self.ERROR_SEVERITY.items():
-            if error_code in codes:
-                return {
-                    "severe": "嚴重警告",
-                    "high": "重要警告",
-                    "medium": "次要警告",
-                    "low": "提示"
-                }[level]
-        return "未知等級"  # 預設值
+        """根據 `error_code` 分類告警等級 (多個錯誤同時發生時取最高等級)"""
+        return decode_error_code(error_code)[1]
     
 
     def filter_data(self, data):
@@ -103,11 +167,8 @@ class GoodWe:
         filtered_data = self.filter_data(data)
         error_code = data.get("errormessage", 0)  # 取得錯誤碼 (預設為 0)
         
-        matched_errors = []
-        for bit, message in self.ERROR_MESSAGE_MAP.items():
-            if error_code & bit:  # 使用位元運算判斷錯誤碼是否包含該錯誤
-                matched_errors = message
-        alert_level = self.classify_alert_level(error_code)
+        messages, alert_level = decode_error_code(error_code)
+        matched_errors = messages[0] if messages else None  # 與先前相同：取最低位元的錯誤訊息
         # ✅ 新增告警欄位（繁體）
         alert_data = {
             "alertlevel":alert_level,  # 告警等級
@@ -129,7 +190,49 @@ class GoodWe:
         
         return merged_data  # 回傳完整的合併資料
 
+# bit -> (等級順序, 等級名稱, 錯誤訊息)，模組載入時建立一次
+ERROR_BIT_TABLE = MappingProxyType({
+    bit: (ALERT_LEVELS.index(level), ALERT_LEVEL_NAMES[level], ERROR_MESSAGE_MAP[bit])
+    for level, bits in GoodWe.ERROR_SEVERITY.items()
+    for bit in bits
+})
+
+@lru_cache(maxsize=4096)
+def decode_error_code(error_code):
+    """解析錯誤碼，只走訪有設定的 bit (code & -code)
+
+    回傳 (錯誤訊息 tuple，由低位元到高位元, 最高告警等級)。
+    """
+    messages = []
+    highest_rank = -1
+    alert_level = UNKNOWN_ALERT_LEVEL
+
+    code = int(error_code or 0)
+    while code:
+        bit = code & -code  # 取出最低的已設定位元
+        code ^= bit
+
+        entry = ERROR_BIT_TABLE.get(bit)
+        if entry is None:
+            continue
 
+        rank, level_name, message = entry
+        messages.append(message)
+        if rank > highest_rank:
+            highest_rank = rank
+            alert_level = level_name
 
+    return tuple(messages), alert_level
 
+def decode_error_codes(error_codes):
+    """批次解析錯誤碼；電網事件時大量逆變器回報相同錯誤碼，重複的錯誤碼只解析一次"""
+    decoded = {}
+    for error_code in error_codes:
+        if error_code not in decoded:
+            decoded[error_code] = decode_error_code(error_code)
+    return [decoded[error_code] for error_code in error_codes]
 
+@lru_cache(maxsize=None)
+def goodwe_for(devicetype):
+    """每種設備型號共用一個 GoodWe 實例，不必每筆訊息重新建立"""
+    return GoodWe(devicetype)
\ No newline at end of file
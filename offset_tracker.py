@@ -0,0 +1,81 @@
+from confluent_kafka import TopicPartition
+import threading
+
+
+class OffsetTracker:
+    """追蹤每個 partition 已完整落地的最高連續 offset
+
+    一則訊息可能產生多筆資料列 (inverter/alarm)，全部寫入資料庫 (或送進 dead-letter) 後才算完成。
+    只提交到第一則尚未完成的訊息為止，已提交的 offset 一定都已寫入。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outstanding = {}  # (topic, partition) -> {offset: 尚未完成的資料列數}
+        self.next_offsets = {}  # (topic, partition) -> 已取得的最後一則訊息 offset + 1
+        self.committed = {}  # (topic, partition) -> 已提交的 offset
+        self.row_counts = {}  # (topic, partition) -> 尚未完成的資料列總數
+
+    def consumed(self, topic, partition, offset):
+        key = (topic, partition)
+        with self.lock:
+            if offset + 1 > self.next_offsets.get(key, 0):
+                self.next_offsets[key] = offset + 1
+
+    def add_rows(self, source, count=1):
+        """source 為 (topic, partition, offset)"""
+        topic, partition, offset = source
+        with self.lock:
+            pending = self.outstanding.setdefault((topic, partition), {})
+            pending[offset] = pending.get(offset, 0) + count
+            self.row_counts[(topic, partition)] = self.row_counts.get((topic, partition), 0) + count
+
+    def rows_done(self, sources):
+        with self.lock:
+            for topic, partition, offset in sources:
+                pending = self.outstanding.get((topic, partition))
+                if not pending or offset not in pending:
+                    continue  # partition 已被收回
+
+                pending[offset] -= 1
+                self.row_counts[(topic, partition)] -= 1
+                if pending[offset] <= 0:
+                    del pending[offset]
+
+    def in_flight(self):
+        """各 partition 尚未寫入 (或送進 dead-letter) 的資料列數"""
+        with self.lock:
+            return {key: count for key, count in self.row_counts.items() if count}
+
+    def committable(self):
+        """回傳可以安全提交且比上次提交更新的 offsets"""
+        offsets = []
+        with self.lock:
+            for key, next_offset in self.next_offsets.items():
+                pending = self.outstanding.get(key)
+                commit_offset = min(pending) if pending else next_offset
+                if commit_offset > self.committed.get(key, -1):
+                    offsets.append(TopicPartition(key[0], key[1], commit_offset))
+        return offsets
+
+    def mark_committed(self, offsets):
+        with self.lock:
+            for partition in offsets:
+                key = (partition.topic, partition.partition)
+                self.committed[key] = max(self.committed.get(key, -1), partition.offset)
+
+    def forget_committed(self, partitions):
+        """提交失敗時清除紀錄，下一次 committable 會再回傳這些 partition"""
+        with self.lock:
+            for partition in partitions:
+                self.committed.pop((partition.topic, partition.partition), None)
+
+    def forget(self, partitions):
+        """partition 被收回 (rebalance) 後不再追蹤"""
+        with self.lock:
+            for partition in partitions:
+                key = (partition.topic, partition.partition)
+                self.outstanding.pop(key, None)
+                self.row_counts.pop(key, None)
+                self.next_offsets.pop(key, None)
+                self.committed.pop(key, None)
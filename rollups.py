@@ -0,0 +1,135 @@
+from functools import lru_cache
+from sqlalchemy import text, func, case
+from sqlalchemy.sql import table as table_clause, column as column_clause
+from sqlalchemy.dialects.postgresql import insert
+
+# 彙總表名稱 -> 時間區間 (分鐘)
+ROLLUP_INTERVALS = {
+    "inverter_5m": 5,
+    "inverter_1h": 60,
+    "inverter_1d": 1440,
+}
+
+# 需要彙總的量測欄位結尾
+ROLLUP_FIELD_SUFFIXES = ("power", "energy", "voltage", "current")
+
+ROLLUP_KEY_COLUMNS = ("serialnumber", "bucket", "field")
+ROLLUP_VALUE_COLUMNS = ("samples", "sum_value", "min_value", "max_value", "last_value", "last_time")
+
+def bucket_start(collect_time, minutes):
+    """collecttime ('YYYY-MM-DD HH:MM:SS') 所屬區間的起始時間，以字串切割計算，不必轉成 datetime"""
+    if minutes == 1440:
+        return collect_time[:10] + " 00:00:00"
+    if minutes == 60:
+        return collect_time[:13] + ":00:00"
+    return f"{collect_time[:14]}{int(collect_time[14:16]) // minutes * minutes:02d}:00"
+
+@lru_cache(maxsize=4096)
+def rollup_fields(columns):
+    """欄位組合中需要彙總的欄位，同型號設備的欄位組合相同，只需判斷一次"""
+    return tuple(column for column in columns if column.endswith(ROLLUP_FIELD_SUFFIXES))
+
+BASE_INTERVAL = min(ROLLUP_INTERVALS.values())
+
+def merge_values(entry, values):
+    """把另一組 [筆數, 總和, 最小, 最大, 最後值, 最後時間] 合併進 entry"""
+    entry[0] += values[0]
+    entry[1] += values[1]
+    if values[2] < entry[2]:
+        entry[2] = values[2]
+    if values[3] > entry[3]:
+        entry[3] = values[3]
+    if values[5] >= entry[5]:
+        entry[4] = values[4]
+        entry[5] = values[5]
+
+def accumulate(entries, rows, fields):
+    """把寫入的資料列 (serialnumber, collecttime, *fields 的值) 累計成彙總增量
+
+    只累計最小區間 (5 分鐘)，1 小時/1 天在 upsert 時才由 5 分鐘的值合併，每筆資料只需更新一個區間。
+    entries: {(serialnumber, 5 分鐘 bucket, field): [筆數, 總和, 最小, 最大, 最後值, 最後時間]}
+    """
+    for serial_number, collect_time, *values in rows:
+        if serial_number is None or collect_time is None:
+            continue
+
+        collect_time = str(collect_time)
+        bucket = bucket_start(collect_time, BASE_INTERVAL)
+
+        for field, value in zip(fields, values):
+            if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+
+            key = (serial_number, bucket, field)
+            entry = entries.get(key)
+            if entry is None:
+                entries[key] = [1, value, value, value, value, collect_time]
+                continue
+
+            entry[0] += 1
+            entry[1] += value
+            if value < entry[2]:
+                entry[2] = value
+            if value > entry[3]:
+                entry[3] = value
+            if collect_time >= entry[5]:
+                entry[4] = value
+                entry[5] = collect_time
+
+def rollup_rows(entries):
+    """把 5 分鐘的累計值合併成各彙總表的 upsert 參數"""
+    rows_by_table = {}
+    for table_name, minutes in ROLLUP_INTERVALS.items():
+        merged = {}
+        for (serial_number, bucket, field), values in entries.items():
+            key = (serial_number, bucket_start(bucket, minutes), field)
+            entry = merged.get(key)
+            if entry is None:
+                merged[key] = list(values)
+            else:
+                merge_values(entry, values)
+
+        rows_by_table[table_name] = [
+            dict(zip(ROLLUP_KEY_COLUMNS + ROLLUP_VALUE_COLUMNS, (*key, *values)))
+            for key, values in merged.items()
+        ]
+    return rows_by_table
+
+def create_rollup_tables(connection, schema_name):
+    for table_name in ROLLUP_INTERVALS:
+        connection.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS "{schema_name}"."{table_name}" (
+                serialnumber CHARACTER VARYING(125) NOT NULL,
+                bucket TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                field CHARACTER VARYING(125) NOT NULL,
+                samples INTEGER NOT NULL,
+                sum_value DOUBLE PRECISION,
+                min_value DOUBLE PRECISION,
+                max_value DOUBLE PRECISION,
+                last_value DOUBLE PRECISION,
+                last_time TIMESTAMP WITHOUT TIME ZONE,
+                PRIMARY KEY (serialnumber, bucket, field)
+            )
+        """))
+
+@lru_cache(maxsize=1024)
+def build_rollup_statement(schema_name, table_name):
+    """INSERT ... ON CONFLICT DO UPDATE：筆數與總和相加、最小/最大取極值、最後值取時間較新者"""
+    target = table_clause(table_name, *[column_clause(k) for k in ROLLUP_KEY_COLUMNS + ROLLUP_VALUE_COLUMNS], schema=schema_name)
+    statement = insert(target)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=list(ROLLUP_KEY_COLUMNS),
+        set_={
+            "samples": target.c.samples + excluded.samples,
+            "sum_value": target.c.sum_value + excluded.sum_value,
+            "min_value": func.least(target.c.min_value, excluded.min_value),
+            "max_value": func.greatest(target.c.max_value, excluded.max_value),
+            "last_value": case((excluded.last_time >= target.c.last_time, excluded.last_value), else_=target.c.last_value),
+            "last_time": func.greatest(target.c.last_time, excluded.last_time),
+        },
+    )
+
+def upsert_rollups(connection, schema_name, entries):
+    for table_name, rows in rollup_rows(entries).items():
+        connection.execute(build_rollup_statement(schema_name, table_name), rows)
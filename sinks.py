@@ -0,0 +1,215 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+from functools import lru_cache
+from influxdb_client import InfluxDBClient, WriteOptions
+from influxdb_client.client.write_api import WritePrecision
+import math
+import threading
+import metrics
+
+try:
+    import orjson
+except ImportError:  # 未安裝時以 repr 格式化數值
+    orjson = None
+
+
+class Sink(ABC):
+    """PostgreSQL 以外的寫出目的地
+
+    consumer 把路由後的每筆資料列交給各 sink 的 write (只放進記憶體緩衝，不做 I/O)，
+    flush 只把緩衝交給 sink 自己的背景執行緒送出並立即返回，慢的 sink 不會擋住 consumer 與其他 sink。
+    這些 sink 不影響 offset 提交，送出失敗時依各自的重試策略處理。
+    """
+
+    name = "sink"
+
+    @abstractmethod
+    def write(self, schema_name, table_name, data):
+        """放入一筆資料列，只做記憶體操作"""
+
+    def flush(self, force=False):
+        pass
+
+    def pending(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+LINE_PROTOCOL_ESCAPES = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ "})
+
+@lru_cache(maxsize=4096)
+def escape_key(key):
+    """measurement/tag/field 名稱中的逗號、等號與空白需跳脫"""
+    return str(key).translate(LINE_PROTOCOL_ESCAPES)
+
+@lru_cache(maxsize=4096)
+def field_prefixes(keys):
+    """欄位組合對應的 'key=' 字串，同型號設備的欄位組合相同，只需跳脫一次"""
+    return tuple(f"{escape_key(key)}=" for key in keys)
+
+def format_numbers(values):
+    """數值格式化成 line protocol 的 float 欄位值 (整數不加 i 結尾即視為 float)，非有限值為 None
+
+    orjson 一次格式化整列數值，比逐一 repr(float) 快約一倍。
+    """
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(values)
+        except orjson.JSONEncodeError:  # 超過 64-bit 的整數
+            encoded = b"null"
+        if b"null" not in encoded:  # NaN/Infinity 會被編碼成 null
+            return encoded[1:-1].decode().split(",")
+    return [repr(float(value)) if math.isfinite(value) else None for value in values]
+
+@lru_cache(maxsize=65536)
+def epoch_seconds(collect_time):
+    """collecttime ('YYYY-MM-DD HH:MM:SS'，本地時間) 轉成 epoch 秒，無法解析時回傳 None"""
+    try:
+        return int(datetime.fromisoformat(collect_time).timestamp())
+    except ValueError:
+        return None
+
+def to_line_protocol(schema_name, table_name, data):
+    """一筆資料列轉成 line protocol
+
+    measurement 為資料表名稱，tag 為 customer (schema) 與 device (serialnumber)，
+    數值欄位一律以 float 寫入 (同一欄位型別不會因 0 與 0.5 而衝突)，文字欄位不寫入。
+    沒有數值欄位時回傳 None。
+    """
+    keys = []
+    values = []
+    for key, value in data.items():
+        value_type = value.__class__
+        if value_type is bool:
+            value = int(value)
+        elif value_type is not float and value_type is not int:
+            continue  # None、文字與其他型別
+        keys.append(key)
+        values.append(value)
+    if not keys:
+        return None
+
+    fields = ",".join([prefix + value for prefix, value in zip(field_prefixes(tuple(keys)), format_numbers(values))
+                       if value is not None])
+    if not fields:
+        return None
+
+    line = f"{escape_key(table_name)},customer={escape_key(schema_name)}"
+    serial_number = data.get("serialnumber")
+    if serial_number is not None and serial_number != "":
+        line += f",device={escape_key(serial_number)}"
+    line += " " + fields
+
+    collect_time = data.get("collecttime")
+    timestamp = epoch_seconds(str(collect_time)) if collect_time is not None else None
+    if timestamp is not None:
+        line += f" {timestamp}"
+    return line
+
+
+class InfluxSink(Sink):
+    """以 line protocol 批次寫入 InfluxDB
+
+    write 只把資料列放進緩衝；sink 自己的執行緒在累積 batch_size 筆或等待超過 flush_interval_ms 後
+    把整批轉成 line protocol，組成一個字串交給 influxdb-client 的 batching write_api 非同步送出，
+    失敗時依 retry_interval_ms/max_retries 指數退避重試。轉換與送出都不在 consumer 執行緒上。
+    尚未送達的筆數超過 max_pending 時 (InfluxDB 太慢或無法連線) 丟棄新的資料並計數，避免記憶體無限增長。
+    """
+
+    name = "influxdb"
+
+    def __init__(self, url, token, org, bucket, batch_size=5000, flush_interval_ms=1000,
+                 retry_interval_ms=5000, max_retries=5, max_pending=500_000):
+        self.bucket = bucket
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.rows = []  # (schema, table, data)
+        self.in_flight = 0  # 已交給 write_api、尚未成功或放棄的筆數
+        self.ready = threading.Event()  # 緩衝已滿一批或要求立即送出
+        self.closing = False
+
+        self.client = InfluxDBClient(url=url, token=token, org=org)
+        # 每個 record 已是一整批，write_api 不再合併 (batch_size=1)，只負責非同步送出與重試
+        self.write_api = self.client.write_api(
+            write_options=WriteOptions(batch_size=1, flush_interval=flush_interval_ms,
+                                       retry_interval=retry_interval_ms, max_retries=max_retries),
+            success_callback=self.on_success,
+            error_callback=self.on_error,
+            retry_callback=self.on_retry,
+        )
+        self.thread = threading.Thread(target=self.run, name="influxdb-sink", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def line_count(data):
+        return data.count(b"\n" if isinstance(data, bytes) else "\n") + 1
+
+    def on_success(self, conf, data):
+        count = self.line_count(data)
+        with self.lock:
+            self.in_flight -= count
+        metrics.increment("sink_rows_written_total", count, sink=self.name)
+
+    def on_error(self, conf, data, exception):
+        count = self.line_count(data)
+        with self.lock:
+            self.in_flight -= count
+        metrics.increment("sink_rows_failed_total", count, sink=self.name)
+        print(f"{datetime.now()} InfluxDB write failed after retries, dropped {count} rows: {exception}")
+
+    def on_retry(self, conf, data, exception):
+        metrics.increment("sink_retries_total", sink=self.name)
+        print(f"{datetime.now()} InfluxDB write failed, retrying: {exception}")
+
+    def write(self, schema_name, table_name, data):
+        with self.lock:
+            if len(self.rows) + self.in_flight >= self.max_pending:
+                metrics.increment("sink_rows_dropped_total", sink=self.name)
+                return
+            self.rows.append((schema_name, table_name, data))
+            if len(self.rows) >= self.batch_size:
+                self.ready.set()
+
+    def flush(self, force=False):
+        """要求 sink 執行緒立即送出緩衝中的資料，不等待完成"""
+        if force:
+            self.ready.set()
+
+    def run(self):
+        while not self.closing:
+            self.ready.wait(self.flush_interval)
+            self.ready.clear()
+            try:
+                self.send()
+            except Exception as e:
+                print(f"{datetime.now()} Failed to send rows to InfluxDB: {e}")
+
+    def send(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return
+
+        lines = [line for line in (to_line_protocol(*row) for row in rows) if line is not None]
+        with self.lock:
+            self.in_flight += len(lines)
+        for start in range(0, len(lines), self.batch_size):
+            self.write_api.write(bucket=self.bucket, record="\n".join(lines[start:start + self.batch_size]),
+                                 write_precision=WritePrecision.S)
+
+    def pending(self):
+        with self.lock:
+            return len(self.rows) + self.in_flight
+
+    def close(self):
+        """送出剩餘資料並等待 write_api 完成 (包含重試中的批次)"""
+        self.closing = True
+        self.ready.set()
+        self.thread.join()
+        self.send()
+        self.write_api.close()
+        self.client.close()
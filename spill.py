@@ -0,0 +1,124 @@
+from pathlib import Path
+import json
+import os
+import threading
+import time
+
+
+class SpillFull(Exception):
+    pass
+
+
+class SpillStore:
+    """資料庫無法寫入時暫存批次的本機檔案
+
+    每個 schema 一個目錄，每批寫成一個 segment 檔 (先寫暫存檔、fsync 後 rename，不會留下寫一半的檔案)，
+    檔名依寫入順序排序，drainer 依序重播。總大小超過 max_bytes 時拋出 SpillFull。
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.size = 0
+        self.segment_counts = {}  # schema -> segment 數量
+        self.rejected = False  # 曾因空間不足拒絕寫入，drainer 清出空間或資料庫恢復寫入前視為已滿
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for schema_dir in self.directory.iterdir():
+            if not schema_dir.is_dir():
+                continue
+            for segment in schema_dir.glob("*.tmp"):
+                segment.unlink()  # 上次寫到一半就中斷的暫存檔
+            segments = list(schema_dir.glob("*.seg"))
+            if segments:
+                self.segment_counts[schema_dir.name] = len(segments)
+                self.size += sum(segment.stat().st_size for segment in segments)
+
+    def is_full(self):
+        return self.rejected or self.size >= self.max_bytes
+
+    def clear_rejected(self):
+        """資料庫直接寫入成功時呼叫，不必等 drainer 清出空間就恢復消費"""
+        with self.lock:
+            self.rejected = False
+
+    def usage(self):
+        return self.size / self.max_bytes
+
+    def has_segments(self, schema_name):
+        return self.segment_counts.get(schema_name, 0) > 0
+
+    def schemas(self):
+        with self.lock:
+            return [schema_name for schema_name, count in self.segment_counts.items() if count]
+
+    def write(self, schema_name, groups):
+        """groups 為 [((schema, table, 欄位 tuple), rows)]；彙總值在重播寫入時才由實際寫入的資料列計算"""
+        records = [
+            {"table": table_name, "columns": list(columns), "rows": [[row[k] for k in columns] for row in rows]}
+            for (_, table_name, columns), rows in groups
+        ]
+        payload = "\n".join(json.dumps(record, default=str) for record in records).encode("utf-8")
+
+        with self.lock:
+            if self.size + len(payload) > self.max_bytes:
+                # spill 是空的時 (單一批次就超過 max_bytes) 沒有 segment 可以清出空間，不視為已滿
+                self.rejected = self.size > 0
+                raise SpillFull(f"spill directory {self.directory} is full ({self.size} bytes)")
+            self.sequence += 1
+            name = f"{time.time_ns():020d}-{self.sequence:06d}"
+            self.size += len(payload)
+            self.segment_counts[schema_name] = self.segment_counts.get(schema_name, 0) + 1
+
+        schema_dir = self.directory / schema_name
+        schema_dir.mkdir(exist_ok=True)
+        temp_path = schema_dir / f"{name}.tmp"
+        try:
+            with open(temp_path, "wb") as segment:
+                segment.write(payload)
+                segment.flush()
+                os.fsync(segment.fileno())
+            temp_path.rename(schema_dir / f"{name}.seg")
+        except Exception:
+            with self.lock:
+                self.size -= len(payload)
+                self.segment_counts[schema_name] -= 1
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    def segments(self, schema_name, limit):
+        return sorted((self.directory / schema_name).glob("*.seg"))[:limit]
+
+    def read(self, paths):
+        """讀取多個 segment，合併成 {(schema, table, 欄位 tuple): rows}"""
+        groups = {}
+        for path in paths:
+            schema_name = path.parent.name
+            with open(path, "rb") as segment:
+                for line in segment:
+                    record = json.loads(line)
+                    columns = tuple(record["columns"])
+                    rows = groups.setdefault((schema_name, record["table"], columns), [])
+                    rows.extend(dict(zip(columns, values)) for values in record["rows"])
+        return groups
+
+    def quarantine(self, paths):
+        """無法重播的 segment 改名為 .bad 留待人工處理，不再計入 spill 大小"""
+        for path in paths:
+            size = path.stat().st_size
+            path.rename(path.with_suffix(".bad"))
+            with self.lock:
+                self.size -= size
+                self.segment_counts[path.parent.name] -= 1
+                self.rejected = False
+
+    def remove(self, paths):
+        for path in paths:
+            size = path.stat().st_size
+            path.unlink()
+            with self.lock:
+                self.size -= size
+                self.segment_counts[path.parent.name] -= 1
+                self.rejected = False
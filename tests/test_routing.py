@@ -0,0 +1,92 @@
+"""process_message 的路由與無法解析訊息的處理測試：以 monkeypatch 攔截 buffer_row，不需要 Kafka 與 PostgreSQL
+
+    python -m pytest tests
+"""
+import base64
+import json
+import os
+
+import pytest
+
+# kafka_handler 在 import 時讀取設定並建立 engine (不會立即連線)
+os.environ.setdefault("DATABASE_URL", "postgresql://test@localhost/test")
+import kafka_handler  # noqa: E402
+from modbus_mapping import ERROR_BITS
+from offset_tracker import OffsetTracker
+
+
+class Message:
+    def __init__(self, topic, payload, partition=0, offset=0):
+        self._topic = topic
+        self._value = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self._partition = partition
+        self._offset = offset
+
+    def topic(self):
+        return self._topic
+
+    def key(self):
+        return None
+
+    def value(self):
+        return self._value
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+
+@pytest.fixture
+def buffered(monkeypatch):
+    rows = []
+    monkeypatch.setattr(kafka_handler, "buffer_row",
+                        lambda row_buffer, schema_name, table_name, data, source=None: rows.append((table_name, data)))
+    return rows
+
+
+def payload(error_message, serial_number="SN1"):
+    return {"inverter_brand": "other", "devicetype": "x", "serialnumber": serial_number,
+            "collecttime": "2025-01-01 00:00:00", "errormessage": error_message, "totalpower": 1.5}
+
+
+def test_device_error_code_is_used_for_alarm(buffered):
+    kafka_handler.process_message(Message("9001", payload(4)), kafka_handler.RowBuffer())
+
+    assert [(table_name, data["errormessage"]) for table_name, data in buffered] == [("alarm", 4)]
+
+
+def test_synthetic_error_code_only_without_device_error(buffered, monkeypatch):
+    synthetic = next(bit for bit in ERROR_BITS if bit != 4)
+    monkeypatch.setattr(kafka_handler.random, "choice", lambda choices: synthetic)
+
+    kafka_handler.process_message(Message("9001", payload(0, "SN2")), kafka_handler.RowBuffer())
+
+    assert [(table_name, data["errormessage"]) for table_name, data in buffered] == [("inverter", 0), ("alarm", synthetic)]
+
+
+def test_undecodable_message_goes_to_reject_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(kafka_handler, "DEAD_LETTER_TOPIC", "")
+    monkeypatch.setattr(kafka_handler, "REJECT_FILE", str(tmp_path / "rejected.jsonl"))
+    tracker = OffsetTracker()
+    tracker.consumed("9001", 0, 7)
+    raw = b"\xff\x00not json"
+
+    kafka_handler.reject_message(Message("9001", raw, offset=7), ValueError("bad payload"), tracker)
+
+    record = json.loads((tmp_path / "rejected.jsonl").read_text())
+    assert (record["topic"], record["offset"], record["value_encoding"]) == ("9001", 7, "base64")
+    assert base64.b64decode(record["value"]) == raw
+    assert [(p.topic, p.offset) for p in tracker.committable()] == [("9001", 8)]
+
+
+def test_offset_held_back_when_message_cannot_be_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(kafka_handler, "DEAD_LETTER_TOPIC", "")
+    monkeypatch.setattr(kafka_handler, "REJECT_FILE", str(tmp_path / "missing" / "rejected.jsonl"))
+    tracker = OffsetTracker()
+    tracker.consumed("9001", 0, 7)
+
+    kafka_handler.reject_message(Message("9001", b"not json", offset=7), ValueError("bad payload"), tracker)
+
+    assert [(p.topic, p.offset) for p in tracker.committable()] == [("9001", 7)]
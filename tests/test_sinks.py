@@ -0,0 +1,191 @@
+"""InfluxSink 與 line protocol 的測試，以本機 HTTP 伺服器模擬 InfluxDB 的 /api/v2/write
+
+    python -m pytest tests
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+import pytest
+
+import metrics
+from sinks import InfluxSink, Sink, to_line_protocol
+
+
+class InfluxStandIn:
+    """依序回應 statuses 中的狀態碼 (用完後回應 204)，記錄每個請求的內容"""
+
+    def __init__(self, statuses=()):
+        stand_in = self
+        self.statuses = list(statuses)
+        self.bodies = []
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stand_in.lock:
+                    status = stand_in.statuses.pop(0) if stand_in.statuses else 204
+                    stand_in.bodies.append((status, body.decode()))
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def accepted_lines(self):
+        with self.lock:
+            return [line for status, body in self.bodies if status == 204 for line in body.split("\n")]
+
+    def request_count(self):
+        with self.lock:
+            return len(self.bodies)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in_factory():
+    created = []
+
+    def create(statuses=()):
+        stand_in = InfluxStandIn(statuses)
+        created.append(stand_in)
+        return stand_in
+
+    yield create
+    for stand_in in created:
+        stand_in.close()
+
+
+@pytest.fixture
+def sink_factory():
+    created = []
+
+    def create(stand_in, **options):
+        sink = InfluxSink(stand_in.url, "token", "org", "bucket", **options)
+        created.append(sink)
+        return sink
+
+    yield create
+    for sink in created:
+        sink.close()
+
+
+def counter(name, sink="influxdb"):
+    counters, _, _ = metrics.snapshot()
+    return counters.get((name, (("sink", sink),)), 0)
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def row(serial_number="SN1", **fields):
+    return {"serialnumber": serial_number, "collecttime": "2024-01-02 03:04:05", **fields}
+
+
+def test_sink_requires_write():
+    with pytest.raises(TypeError):
+        Sink()
+
+
+def test_line_protocol_escapes_names_and_tags():
+    line = to_line_protocol("1001", "my table", row("SN 1,a=b", **{"pv,1 v=x": 1.5}))
+    timestamp = line.rsplit(" ", 1)[1]
+    assert line == f"my\\ table,customer=1001,device=SN\\ 1\\,a\\=b pv\\,1\\ v\\=x=1.5 {timestamp}"
+
+
+@pytest.mark.parametrize("extra", [{}, {"broken": float("nan"), "big": 2 ** 70}])
+def test_line_protocol_numeric_formatting(extra):
+    line = to_line_protocol("1001", "inverter", row(
+        power=1.25, energy=7, enabled=True, text="skip", missing=None, **extra,
+    ))
+    _, fields, timestamp = line.split(" ")
+    values = dict(field.split("=") for field in fields.split(","))
+    # 整數與布林值都以 float 寫入 (沒有 i 結尾)，文字、None 與非有限值不寫入
+    assert not any(value.endswith("i") for value in values.values())
+    expected = {"power": 1.25, "energy": 7.0, "enabled": 1.0}
+    if extra:
+        expected["big"] = float(2 ** 70)
+    assert {key: float(value) for key, value in values.items()} == expected
+    assert int(timestamp) > 0
+
+
+def test_line_protocol_without_numeric_fields():
+    assert to_line_protocol("1001", "inverter", {"serialnumber": "SN1", "collecttime": None, "note": "x"}) is None
+
+
+def test_batches_rows_into_requests(stand_in_factory, sink_factory):
+    stand_in = stand_in_factory()
+    sink = sink_factory(stand_in, batch_size=3, flush_interval_ms=500)
+
+    for index in range(7):
+        sink.write("1001", "inverter", row(f"SN{index}", power=float(index)))
+    sink.flush(force=True)
+
+    assert wait_until(lambda: len(stand_in.accepted_lines()) == 7)
+    assert stand_in.request_count() == 3  # 3 + 3 + 1
+    assert wait_until(lambda: sink.pending() == 0)
+
+
+def test_retries_failed_writes(stand_in_factory, sink_factory):
+    stand_in = stand_in_factory([503, 503])
+    retries = counter("sink_retries_total")
+    written = counter("sink_rows_written_total")
+    sink = sink_factory(stand_in, flush_interval_ms=500, retry_interval_ms=10, max_retries=5)
+
+    sink.write("1001", "inverter", row(power=1.0))
+    sink.write("1001", "inverter", row("SN2", power=2.0))
+    sink.flush(force=True)
+
+    assert wait_until(lambda: len(stand_in.accepted_lines()) == 2)
+    assert stand_in.request_count() == 3
+    assert wait_until(lambda: sink.pending() == 0)
+    assert counter("sink_retries_total") - retries == 2
+    assert counter("sink_rows_written_total") - written == 2
+
+
+def test_gives_up_after_max_retries(stand_in_factory, sink_factory):
+    stand_in = stand_in_factory([503] * 10)
+    failed = counter("sink_rows_failed_total")
+    sink = sink_factory(stand_in, flush_interval_ms=500, retry_interval_ms=10, max_retries=1)
+
+    sink.write("1001", "inverter", row(power=1.0))
+    sink.flush(force=True)
+
+    assert wait_until(lambda: sink.pending() == 0)
+    assert counter("sink_rows_failed_total") - failed == 1
+    assert stand_in.request_count() == 2
+    assert stand_in.accepted_lines() == []
+
+
+def test_drops_rows_over_max_pending(stand_in_factory, sink_factory):
+    stand_in = stand_in_factory()
+    dropped = counter("sink_rows_dropped_total")
+    sink = sink_factory(stand_in, flush_interval_ms=500, max_pending=2)
+
+    for index in range(5):
+        sink.write("1001", "inverter", row(f"SN{index}", power=1.0))
+
+    assert sink.pending() == 2
+    assert counter("sink_rows_dropped_total") - dropped == 3
+
+    sink.flush(force=True)
+    assert wait_until(lambda: sink.pending() == 0)
+    assert sorted(line.split(",")[2].split(" ")[0] for line in stand_in.accepted_lines()) == ["device=SN0", "device=SN1"]
@@ -0,0 +1,40 @@
+"""SpillStore 的空間判斷測試，只使用暫存目錄
+
+    python -m pytest tests
+"""
+import pytest
+
+from spill import SpillFull, SpillStore
+
+KEY = ("9001", "inverter", ("collecttime", "serialnumber"))
+
+
+def rows(count):
+    return [{"serialnumber": "SN1", "collecttime": f"2025-01-01 00:00:{i:02d}"} for i in range(count)]
+
+
+def test_oversized_batch_does_not_mark_empty_spill_full(tmp_path):
+    store = SpillStore(tmp_path, max_bytes=100)
+
+    with pytest.raises(SpillFull):
+        store.write("9001", [(KEY, rows(10))])
+
+    assert not store.is_full()
+    assert not store.has_segments("9001")
+
+
+def test_rejected_spill_stays_full_until_space_or_direct_write(tmp_path):
+    store = SpillStore(tmp_path, max_bytes=300)
+    store.write("9001", [(KEY, rows(2))])
+
+    with pytest.raises(SpillFull):
+        store.write("9001", [(KEY, rows(10))])
+    assert store.is_full()
+
+    store.clear_rejected()
+    assert not store.is_full()
+
+    with pytest.raises(SpillFull):
+        store.write("9001", [(KEY, rows(10))])
+    store.remove(store.segments("9001", 10))
+    assert not store.is_full()